@@ -0,0 +1,80 @@
+'''Support for coroutine functions.
+
+An imported function defined with "async def" returns a coroutine when
+called. The command loop schedules the coroutine on an event loop owned
+by the server, which runs on a thread of its own, and carries on with
+the queue; the result is awaited only when a later command needs it, or
+when the queue's result is returned. Coroutines started by different
+commands of a queue, or by the queues of a single CallMany() batch, thus
+run concurrently.'''
+
+import asyncio
+import threading
+
+from . import workers
+
+_lock = threading.Lock()
+_loop = None
+
+
+def loop():
+    '''Returns the event loop, starting it on first use.'''
+    global _loop
+    if _loop is None:
+        with _lock:
+            if _loop is None:
+                new_loop = asyncio.new_event_loop()
+                threading.Thread(target=new_loop.run_forever, name='axl-asyncio', daemon=True).start()
+                _loop = new_loop
+    return _loop
+
+
+class Pending(object):
+    '''The eventual result of a coroutine running on the event loop.
+
+    Attributes:
+        name: the name of the command that returned the coroutine.
+        future: a concurrent.futures.Future for its result.
+        traceback: the traceback of the exception the coroutine raised, if
+            any, as first seen.'''
+    __slots__ = ('name', 'future', 'traceback')
+
+    def __init__(self, name, future):
+        self.name = name
+        self.future = future
+        self.traceback = None
+
+    def result(self):
+        '''Waits for the coroutine to finish, and returns its result. If the
+        coroutine raised an exception, so does this. The same exception is
+        raised every time; its traceback is restored first, since each
+        raise would otherwise extend it, and identical failures would no
+        longer share an error code; see axl.errors.'''
+        exc = self.future.exception()
+        if exc is None:
+            return self.future.result()
+        if self.traceback is None:
+            self.traceback = exc.__traceback__
+        raise exc.with_traceback(self.traceback)
+
+
+async def _bounded(coro, timeout):
+    try:
+        return await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        raise workers.Timeout('Exceeded the time budget of {} seconds'.format(timeout))
+
+
+def submit(name, coro, timeout=None):
+    '''Schedules a coroutine on the event loop.
+
+    Inputs:
+        name: the name of the command that returned the coroutine.
+        coro: the coroutine.
+        timeout: the time budget, in seconds, or None. A coroutine that
+            overruns it is cancelled, and raises axl.workers.Timeout.
+    Outputs:
+        A Pending result.'''
+    if timeout:
+        coro = _bounded(coro, timeout)
+    return Pending(name, asyncio.run_coroutine_threadsafe(coro, loop()))
@@ -0,0 +1,95 @@
+'''The context in which the command loop runs a function.
+
+Functions called from Excel may consult the context to cooperate with
+the command loop. In particular, a long-running function subject to a
+time budget should call check(), or test cancelled(), periodically, so
+that it stops promptly once its result is no longer wanted.
+
+A function whose result goes straight to the calling range may also ask
+for the shape of that range, with caller_shape(), and compute only the
+part of its result that will be shown; see the notes there.'''
+
+import threading
+from time import monotonic
+
+_local = threading.local()
+
+
+class Cancelled(Exception):
+    '''Raised by check() when the current call has been cancelled.'''
+
+
+class CallContext(object):
+    '''The context of a single call.
+
+    Attributes:
+        deadline: the time.monotonic() value at which the call's time
+            budget expires, or None if it has no budget.
+        event: a threading.Event, set when the call is cancelled.
+        callbacks: functions to be called when the call is cancelled.'''
+    __slots__ = ('deadline', 'event', 'callbacks')
+
+    def __init__(self, timeout=None):
+        self.deadline = None if timeout is None else monotonic() + timeout
+        self.event = threading.Event()
+        self.callbacks = []
+
+    def cancel(self):
+        '''Asks the call to stop, and runs the cancellation callbacks.'''
+        self.event.set()
+        for callback in self.callbacks:
+            callback()
+
+    def on_cancel(self, callback):
+        '''Registers a function, taking no arguments, to be called when the
+        call is cancelled; immediately, if it already has been.'''
+        self.callbacks.append(callback)
+        if self.event.is_set():
+            callback()
+
+    def cancelled(self):
+        '''Returns True if the call has been cancelled, or has overrun its
+        time budget.'''
+        return self.event.is_set() or (self.deadline is not None and monotonic() > self.deadline)
+
+
+def current():
+    '''Returns the context of the call running on this thread, or None.'''
+    return getattr(_local, 'context', None)
+
+
+def activate(ctx):
+    '''Makes ctx the context of the call running on this thread.'''
+    _local.context = ctx
+
+
+def caller_shape():
+    '''Returns the shape of the range in which the result of the call
+    running on this thread will be shown, as a (rows, columns, headers)
+    tuple, or None if it is not known. headers is False if a DataFrame
+    result will be shown without its header row.
+
+    The shape is known only when the result is returned to Excel as is,
+    and not used by any other command. Whatever lies outside the range
+    is then discarded, so a function may leave it out: for instance,
+    return only the first rows of a sorted table. It must otherwise
+    return what it would have returned without the shape.'''
+    return getattr(_local, 'shape', None)
+
+
+def set_caller_shape(shape):
+    '''Sets the shape returned by caller_shape() on this thread.'''
+    _local.shape = shape
+
+
+def cancelled():
+    '''Returns True if the call running on this thread has been cancelled.'''
+    ctx = current()
+    return ctx is not None and ctx.cancelled()
+
+
+def check():
+    '''Raises Cancelled if the call running on this thread has been
+    cancelled; otherwise, does nothing.'''
+    if cancelled():
+        raise Cancelled('The call was cancelled')
@@ -3,12 +3,22 @@ __all__ = ['from_excel', 'to_excel']
 import pandas as pd
 import numpy as np
 
-from pywintypes import TimeType
 from datetime import datetime
 from functools import singledispatch
-from win32timezone import TimeZoneInfo
 
-winUTC = TimeZoneInfo('GMT Standard Time', True)
+try:
+    from pywintypes import TimeType
+    from win32timezone import TimeZoneInfo
+    winUTC = TimeZoneInfo('GMT Standard Time', True)
+except ImportError:
+    # Without pywin32 (e.g., when the command loop is driven by a Python
+    # client rather than by Excel), dates are exchanged as datetimes.
+    from datetime import timezone
+    TimeType = datetime
+    winUTC = timezone.utc
+
+# Types that cleanin() returns unchanged, and need not be dispatched
+_scalars = {str, float, int, bool, type(None)}
 
 
 # A recursive routine to convert Windows dates to naive
@@ -54,7 +64,7 @@ def trim_array(var, nr, nc, headers):
     if var.size == 0:
         return None
     elif var.size == 1:
-        return np.asscalar(var)
+        return var.item()
     elif var.ndim == 1:
         return var[:nr, None] if nc == 1 else var[None, :nc]
     elif var.ndim == 2:
@@ -136,12 +146,12 @@ def cleanout_dataframe(arg):
     index = type(arg.index) is pd.MultiIndex or arg.index.name is not None
     for col in arg.columns[arg.dtypes.values == np.dtype('<M8[ns]')]:
         arg[col] = arg[col].astype(datetime)
-    arg = pd.DataFrame(arg).to_records(index, False)
+    arg = pd.DataFrame(arg).to_records(index=index)
     return (arg.dtype.names,) + cleanout(arg.tolist())
 
 
 def from_excel(val):
-    return cleanin(val)
+    return val if type(val) in _scalars else cleanin(val)
 
 
 def to_excel(val, nr, nc, headers=True):
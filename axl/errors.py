@@ -0,0 +1,114 @@
+'''Compact error reporting.
+
+When a cell fails, every cell that depends on it fails too, often
+thousands at once, and usually with the very same exception. Rather than
+formatting a traceback for each of them, the command loop records the
+failure in a bounded table and returns a short error code such as
+"#PYTHON?E12". Identical failures---the same command, exception type,
+message and traceback locations---share a single entry, and hence a
+single code, and the traceback is formatted only the first time. The
+full text of an error is retrieved on demand with the %Error command.'''
+
+import threading
+from traceback import format_tb, walk_tb
+from collections import OrderedDict
+
+PREFIX = '#PYTHON?'
+MAX_ERRORS = 1024
+
+
+class ErrorTable(object):
+    '''A thread-safe table of error descriptions, deduplicated by key and
+    bounded in size; the least recently reported errors are dropped first.
+
+    Attributes:
+        max_errors: the maximum number of entries.
+        reported: the number of errors reported, including duplicates.'''
+
+    def __init__(self, max_errors=MAX_ERRORS):
+        self.max_errors = max_errors
+        self.codes = {}
+        self.entries = OrderedDict()
+        self.next_code = 1
+        self.reported = 0
+        self.lock = threading.Lock()
+
+    def report(self, key, describe):
+        '''Records an error, and returns its code.
+
+        Inputs:
+            key: a hashable key; errors with equal keys share an entry.
+            describe: a function, taking no arguments, that returns the
+                (summary, text) of the error. It is called only for an
+                error that is not already in the table.
+        Outputs:
+            The error string to return to Excel; e.g., "#PYTHON?E12".'''
+        with self.lock:
+            self.reported += 1
+            code = self.codes.get(key)
+            if code is not None:
+                self.entries[code][2] += 1
+                self.entries.move_to_end(code)
+                return PREFIX + 'E' + str(code)
+        summary, text = describe()
+        with self.lock:
+            code = self.codes.get(key)
+            if code is None:
+                code = self.codes[key] = self.next_code
+                self.next_code += 1
+                self.entries[code] = [key, (summary, text), 0]
+                while len(self.entries) > self.max_errors:
+                    del self.codes[self.entries.popitem(last=False)[1][0]]
+            self.entries[code][2] += 1
+            self.entries.move_to_end(code)
+        return PREFIX + 'E' + str(code)
+
+    def lookup(self, code):
+        '''Returns the full text of an error, given its code as a number, or
+        in the form "E12" or "#PYTHON?E12"; or None if it is not (or no
+        longer) in the table.'''
+        if type(code) is str:
+            code = code[len(PREFIX):] if code.startswith(PREFIX) else code
+            code = code[1:] if code[:1] in ('E', 'e') else code
+        with self.lock:
+            entry = self.entries.get(int(code))
+            return None if entry is None else entry[1][1]
+
+    def summary(self):
+        '''Returns the errors in the table, most recent first, as a table
+        with the code, the number of occurrences, and a one-line summary.'''
+        with self.lock:
+            return tuple(('E' + str(code), entry[2], entry[1][0])
+                         for code, entry in reversed(self.entries.items()))
+
+    def clear(self):
+        '''Removes all errors from the table. Codes are not reused.'''
+        with self.lock:
+            self.codes.clear()
+            self.entries.clear()
+
+
+table = ErrorTable()
+
+
+def report_exception(cmd_name, etype, value, tb):
+    '''Records an exception raised by a command, and returns its code.
+    Two exceptions are considered identical if they were raised by the same
+    command, with the same type and message, at the same locations.'''
+    message = str(value)
+    where = tuple((frame.f_code.co_filename, lineno) for frame, lineno in walk_tb(tb))
+
+    def describe():
+        summary = '{}: {}: {}'.format(cmd_name, etype.__name__, message)
+        tt = "   ".join(format_tb(tb))
+        return summary, '''#PYTHON?
+                    Error encountered executing Python function {}:
+                        {}: {}
+                        {}'''.format(cmd_name, etype.__name__, message, tt)
+    return table.report((cmd_name, etype, message, where), describe)
+
+
+def report_text(summary, text):
+    '''Records an error described by a ready-made text, and returns its
+    code.'''
+    return table.report(text, lambda: (summary, text))
@@ -0,0 +1,114 @@
+'''Fused execution of common command chains.
+
+Some chains of methods do far more work than their result requires when
+run one command at a time. For instance, the queue built by
+
+    =P("@DFCols", X("@ColDF", A1:Z5000), "columns=", ..., "sortby=", ...)
+
+converts every column of the range to a DataFrame, copies it to reset
+its index, sorts it, copies the selected columns, and finally discards
+all but the rows that fit in the calling range. When a plan ends in such
+a chain, the command loop calls the fused function recorded in the plan
+instead, which computes only what is shown.
+
+A fused function must return exactly what the unfused commands would.
+Whenever it cannot be sure of that---unusual inputs, or any exception---
+it returns DECLINED, and the commands are run one at a time as usual, so
+that errors, too, are reported as before. Fusion can be turned off with
+the "fuse" option of the %Options command.'''
+
+import pandas as pd
+
+from .converters import from_excel, to_excel
+from .methods import TupleMat, TupleVec
+
+DECLINED = object()
+
+# Types that from_excel() leaves unchanged, and whose columns pandas
+# converts to the same values whether a DataFrame holds all of the rows,
+# or only some.
+_plain = {float, str, bool}
+
+
+def _is_plain(rows, n):
+    return set(map(type, [row[n] for row in rows])) <= _plain
+
+
+def _coldf_dfcols_toexcel(steps, queue):
+    # The range is used as received, rather than converted by from_excel():
+    # only the columns that are used are checked, and they must be plain.
+    coldf, dfcols, toexcel = queue[:3]
+    arr = TupleMat(coldf[1])
+    options = {key: from_excel(dfcols[n + 1]) for key, ref, n in steps[1].kwargs}
+    targs = [from_excel(toexcel[n + 1]) for ref, n in steps[2].args[1:]]
+    if len(arr) < 2 or len(targs) not in (2, 3):
+        return DECLINED
+    header, rows = arr[0], arr[1:]
+    width = len(header)
+    if (any(type(label) is not str for label in header) or len(set(header)) != width or
+            'index' in header or any(len(row) != width for row in rows)):
+        return DECLINED
+    position = {label: n for n, label in enumerate(header)}
+
+    # Resolve the columns exactly as DFCols does
+    columns = options.get('columns')
+    columns = list(header) if columns is None else list(TupleVec(columns, arg='columns'))
+    exclude = options.get('exclude')
+    if exclude is not None:
+        exclude = set(TupleVec(exclude, arg='exclude'))
+        columns = [x for x in columns if x not in exclude]
+    if not columns or any(type(x) is not str or x not in position for x in columns):
+        return DECLINED
+    picks = [position[x] for x in columns]
+    if not all(_is_plain(rows, n) for n in picks):
+        return DECLINED
+
+    # Only the rows that fit in the caller's range are needed. The sort
+    # order is found from a DataFrame of the sort keys alone; pandas
+    # converts each column independently, so it is the same order the
+    # full DataFrame would yield.
+    nr, nc = int(targs[0]), int(targs[1])
+    count = len(rows) if nr < 0 or nc < 0 else min(nr, len(rows))
+    sortby = options.get('sortby')
+    if sortby is None:
+        head = range(count)
+    else:
+        sortby = list(TupleVec(sortby, arg='sortby', flatten=True))
+        ascending = list(TupleVec(options.get('ascending', True), arg='ascending', flatten=True))
+        if len(set(sortby)) != len(sortby) or any(type(x) is not str or x not in position for x in sortby):
+            return DECLINED
+        keys = [position[x] for x in sortby]
+        if not all(_is_plain(rows, n) for n in keys):
+            return DECLINED
+        keys = pd.DataFrame([tuple(row[n] for n in keys) for row in rows], columns=sortby)
+        head = keys.sort_values(sortby, ascending=ascending, kind='mergesort').index[:count]
+    shown = pd.DataFrame([tuple(rows[i][n] for n in picks) for i in head], columns=columns)
+    return to_excel(shown, *targs)
+
+
+def match(steps):
+    '''Returns the fused function for a plan, or None if it has none. The
+    function is called with the steps and the queue, and returns either
+    the result of the queue, or DECLINED.'''
+    from .plans import METHOD
+    if (len(steps) != 3 or [step.name for step in steps] != ['ColDF', 'DFCols', 'ToExcel'] or
+            any(step.kind != METHOD or step.error is not None for step in steps)):
+        return None
+    coldf, dfcols, toexcel = steps
+    if coldf.args != ((False, 0),) or coldf.kwargs:
+        return None
+    if dfcols.args != ((True, 0),) or any(ref or key not in ('columns', 'exclude', 'sortby', 'ascending')
+                                          for key, ref, n in dfcols.kwargs):
+        return None
+    if (toexcel.args[:1] != ((True, 1),) or toexcel.kwargs or
+            any(ref for ref, n in toexcel.args[1:])):
+        return None
+    return _coldf_dfcols_toexcel
+
+
+def run(fused, steps, queue):
+    '''Calls a fused function, returning DECLINED if it raises an exception.'''
+    try:
+        return fused(steps, queue)
+    except Exception:
+        return DECLINED
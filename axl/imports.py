@@ -1,7 +1,19 @@
-import re, importlib, types, sys, os, glob
+import re, importlib, types, sys, os, glob, builtins, ast
 
 _imports = types.ModuleType('axl_imports')
 _modules = {}
+_options = {}
+
+
+def resolve(name):
+    '''Returns the object referred to by a (possibly dotted) symbol name.
+    The first component is looked up in the AXL imports namespace, or in
+    the Python builtins if it was not imported.'''
+    parts = name.split('.')
+    obj = _imports if hasattr(_imports, parts[0]) else builtins
+    for part in parts:
+        obj = getattr(obj, part)
+    return obj
 
 
 def add_symbol(module_name, symbol_name, value):
@@ -25,8 +37,36 @@ SYMBOL_LIST = SYMBOL_AS + r'(?:\s*,\s*' + SYMBOL_AS + r')*'
 MODULE = SYMBOL + r'(?:[.]' + SYMBOL + r')*'
 MODULE_AS = MODULE + AS_SYMBOL
 MODULE_LIST = MODULE_AS + r'(?:\s*,\s*' + MODULE_AS + r')*' 
-IMPORT_LINE = '^import\s+(' + MODULE_LIST + r')' + EOL
-FROM_LINE = '^from\s+(' + MODULE + r')\s+import\s+(' + SYMBOL_LIST + r'|[*])' + EOL
+OPTION = SYMBOL + r'(?:\s*=\s*[^\s,\]]+)?'
+OPTIONS = r'(?:\s*\[\s*(' + OPTION + r'(?:\s*,\s*' + OPTION + r')*)\s*\])?'
+IMPORT_LINE = '^import\s+(' + MODULE_LIST + r')' + OPTIONS + EOL
+FROM_LINE = '^from\s+(' + MODULE + r')\s+import\s+(' + SYMBOL_LIST + r'|[*])' + OPTIONS + EOL
+
+
+def parse_options(text):
+    '''Parses the bracketed options that may follow an import statement;
+    e.g., "[process]" or "[process, timeout=10]". An option without a value
+    is set to True; values are Python literals, or else plain strings.'''
+    options = {}
+    for opt in re.split(r'\s*,\s*', text.strip()) if text else ():
+        key, _, value = opt.partition('=')
+        key, value = key.strip(), value.strip()
+        if not value:
+            value = True
+        else:
+            try:
+                value = ast.literal_eval(value)
+            except (ValueError, SyntaxError):
+                pass
+        options[key] = value
+    return options
+
+
+def symbol_options(name):
+    '''Returns the options given in the imports files for a (possibly
+    dotted) symbol name, as a dictionary. Dotted names share the options
+    of their first component.'''
+    return _options.get(name.split('.', 1)[0], {})
 
 
 def parse_input_line(line):
@@ -34,11 +74,11 @@ def parse_input_line(line):
         return (None, ())
     match = re.match(IMPORT_LINE, line)
     if match:
-        module, symbols = (None,) + match.groups()
+        module, symbols, options = (None,) + match.groups()
     else:
         match = re.match(FROM_LINE, line)
         if match:
-            module, symbols = match.groups()
+            module, symbols, options = match.groups()
             if module.startswith('.'):
                 raise RuntimeError('Relative imports are not allowed: {}'.format(line))
             mod = importlib.import_module(module)
@@ -50,6 +90,7 @@ def parse_input_line(line):
         symbols = mod.__all__
     else:
         symbols = [name for name in dir(mod) if not name.startswith('_')]
+    options = parse_options(options)
     imports = {}
     for iname in symbols:
         nparts = re.split('\s+as\s+', iname)
@@ -66,6 +107,8 @@ def parse_input_line(line):
         else:
             value = getattr(mod, iname)
         add_symbol(module, oname, value)
+        if options:
+            _options[oname] = options
 
 
 parse_input_line('from axl.methods import *')
@@ -0,0 +1,320 @@
+'''Memoization of pure functions.
+
+A function is declared pure either with the "pure" option in the
+imports files, or with the pure() decorator below. Calls to a pure
+function are cached under the function and a fingerprint of the
+contents of its arguments, so repeated calls with identical inputs---
+from different cells, or from later recalculations---are computed once.
+
+Separately, the command loop may share the results of identical
+commands between the cells of a single recalculation burst; see Burst.
+
+Conversely, a function declared volatile, with the "volatile" option or
+the volatile() decorator, may return different results for the same
+arguments; the command loop never reuses its results.'''
+
+import sys
+import asyncio
+import hashlib
+import threading
+from time import monotonic
+from itertools import count
+from types import ModuleType
+from collections import OrderedDict
+from datetime import date, datetime, time, timedelta
+
+import numpy as np
+import pandas as pd
+
+from . import context
+
+MAX_BYTES = 256 * 1024 * 1024
+BURST_GAP = 0.5
+BURST_ENTRIES = 65536
+
+_hashable = {str, int, float, bool, complex, bytes, type(None),
+             date, datetime, time, timedelta, pd.Timestamp}
+
+
+def pure(func):
+    '''Declares a function to be pure, so that its results may be cached.
+    A pure function must return the same result whenever it is called with
+    the same arguments, and must not modify those arguments.'''
+    func._axl_pure = True
+    return func
+
+
+def volatile(func):
+    '''Declares a function to be volatile, so that its results are never
+    reused; for instance, one that returns random numbers, or reads data
+    that may change between calls.'''
+    func._axl_volatile = True
+    return func
+
+
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _types(obj):
+    # Returns the types of the elements of a (nested) tuple.
+    return tuple(_types(x) if type(x) is tuple else type(x) for x in obj)
+
+
+def fingerprint(obj):
+    '''Returns a hashable key that identifies the contents of an object.
+    Two objects with the same fingerprint are equal (up to hash collisions
+    among array and DataFrame contents, which are hashed with a 128-bit
+    digest).
+
+    Inputs:
+        obj: a scalar, a (nested) tuple, list or dict, a NumPy array, or a
+            Pandas DataFrame or Series.
+    Outputs:
+        the fingerprint.
+    Raises:
+        TypeError if the object, or something it contains, cannot be
+        fingerprinted.'''
+    otype = type(obj)
+    if otype in _hashable:
+        return (otype, obj)
+    elif otype is tuple:
+        try:
+            # Excel ranges are tuples of scalars, and can be hashed directly;
+            # the types of the scalars are added, since True == 1 == 1.0.
+            hash(obj)
+            return (tuple, obj, _types(obj))
+        except TypeError:
+            return (tuple, tuple(map(fingerprint, obj)))
+    elif otype is list:
+        return (list, tuple(map(fingerprint, obj)))
+    elif otype is dict:
+        return (dict, tuple((fingerprint(k), fingerprint(v)) for k, v in obj.items()))
+    elif isinstance(obj, np.generic):
+        return (otype, obj.item())
+    elif isinstance(obj, np.ndarray):
+        if obj.dtype.hasobject:
+            return (otype, obj.shape, fingerprint(obj.ravel().tolist()))
+        return (otype, obj.dtype.str, obj.shape, _digest(np.ascontiguousarray(obj).data))
+    elif isinstance(obj, pd.DataFrame):
+        hashes = pd.util.hash_pandas_object(obj, index=True).values
+        return (otype, fingerprint(list(obj.columns)), tuple(map(str, obj.dtypes)), _digest(hashes.data))
+    elif isinstance(obj, pd.Series):
+        hashes = pd.util.hash_pandas_object(obj, index=True).values
+        return (otype, fingerprint(obj.name), str(obj.dtype), _digest(hashes.data))
+    raise TypeError('Cannot fingerprint an object of type {}'.format(otype.__name__))
+
+
+def sizeof(obj, seen=None):
+    '''Returns an estimate of the memory consumed by an object, in bytes,
+    including the contents of containers, arrays and DataFrames, and the
+    attributes of other objects; e.g., the arrays held by a fitted model.
+    Containers and objects reached more than once are counted once.'''
+    otype = type(obj)
+    if otype in _hashable:
+        return sys.getsizeof(obj)
+    if seen is None:
+        seen = set()
+    elif id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, np.ndarray):
+        size = sys.getsizeof(obj) + (0 if obj.base is None else obj.nbytes)
+        if obj.dtype == object:
+            size += sum(sizeof(x, seen) for x in obj.flat)
+        return size
+    elif isinstance(obj, (pd.DataFrame, pd.Series, pd.Index)):
+        usage = obj.memory_usage(deep=True)
+        return int(usage.sum()) if isinstance(usage, pd.Series) else int(usage)
+    elif isinstance(obj, (tuple, list, set, frozenset)):
+        return sys.getsizeof(obj) + sum(sizeof(x, seen) for x in obj)
+    elif isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(sizeof(k, seen) + sizeof(v, seen) for k, v in obj.items())
+    size = sys.getsizeof(obj)
+    # Functions, classes and modules are shared, not owned by the object.
+    attrs = getattr(obj, '__dict__', None)
+    if type(attrs) is dict and not (callable(obj) or isinstance(obj, ModuleType)):
+        size += sizeof(attrs, seen)
+    return size
+
+
+class MemoCache(object):
+    '''A thread-safe cache of results with least-recently-used eviction,
+    bounded by the total estimated size of the cached values.
+
+    Attributes:
+        max_bytes: the maximum total size of the cached values.
+        nbytes: the current total size of the cached values.
+        hits, misses, evictions: counters of cache activity.'''
+
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        '''Returns the value cached under a key, or default if there is none.'''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        '''Caches a value under a key, evicting the least recently used
+        values as needed to respect the size limit. A value larger than the
+        limit is not cached at all.'''
+        size = sizeof(value)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (value, size)
+            self.nbytes += size
+            self._shrink()
+
+    def _shrink(self):
+        while self.nbytes > self.max_bytes and self.entries:
+            self.nbytes -= self.entries.popitem(last=False)[1][1]
+            self.evictions += 1
+
+    def resize(self, max_bytes):
+        '''Changes the size limit, evicting values as needed.'''
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._shrink()
+
+    def clear(self):
+        '''Removes all cached values. The counters are preserved.'''
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        '''Returns the cache statistics, as a two-column table.'''
+        with self.lock:
+            return (('entries', len(self.entries)), ('bytes', self.nbytes), ('max_bytes', self.max_bytes),
+                    ('hits', self.hits), ('misses', self.misses), ('evictions', self.evictions))
+
+
+class Burst(object):
+    '''Results shared between the cells of a recalculation burst.
+
+    When Excel recalculates, many cells often contain the same command with
+    the same inputs; e.g., X("ColDF", A1:Z5000) feeding different DFCols
+    calls. Each such command is identified by a token, obtained from its
+    name and the values of its arguments, or the tokens of the commands
+    that produced them. The first cell to run it stores the result under
+    its token, and the others reuse it.
+
+    A burst ends when the command loop has been idle for BURST_GAP seconds;
+    all tokens and results are then discarded, so sharing never outlives
+    the recalculation. A timer discards them even if no call follows, so
+    that shared results are not kept in memory.
+
+    Attributes:
+        hits, misses: counters of cache activity.'''
+
+    def __init__(self, gap=BURST_GAP):
+        self.gap = gap
+        self.tokens = {}
+        self.values = {}
+        # Tokens are never reused, so a call that outlives its burst cannot
+        # store its results under the token of a different command.
+        self.counter = count()
+        self.last = 0.0
+        self.timer = None
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def touch(self):
+        '''Marks the start of a call, first ending the burst if the previous
+        call started more than gap seconds ago.'''
+        now = monotonic()
+        with self.lock:
+            if now - self.last > self.gap or len(self.tokens) > BURST_ENTRIES:
+                self.tokens.clear()
+                self.values.clear()
+            self.last = now
+
+    def _expire(self):
+        # Ends the burst once the command loop has been idle long enough.
+        with self.lock:
+            idle = monotonic() - self.last
+            if idle > self.gap:
+                self.tokens.clear()
+                self.values.clear()
+                self.timer = None
+            else:
+                self._schedule(self.gap - idle)
+
+    def _schedule(self, delay):
+        self.timer = threading.Timer(delay + 0.01, self._expire)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def token(self, key):
+        '''Returns the token for a command key, or None if the key contains
+        unhashable values.'''
+        try:
+            with self.lock:
+                token = self.tokens.get(key)
+                if token is None:
+                    token = self.tokens[key] = next(self.counter)
+                return token
+        except TypeError:
+            return None
+
+    def get(self, token, default=None):
+        '''Returns the result stored under a token, or default.'''
+        with self.lock:
+            value = self.values.get(token, default)
+            if value is default:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def put(self, token, value):
+        '''Stores the result of a command under its token.'''
+        with self.lock:
+            self.values[token] = value
+            if self.timer is None:
+                self._schedule(self.gap)
+
+
+cache = MemoCache()
+_missing = object()
+
+
+def call(key, func, *args, **kwargs):
+    '''Calls a pure function through the cache.
+
+    Inputs:
+        key: an object identifying the function; typically the function
+            itself, but see axl.plans for functions run out of process.
+        func: the function to call on a cache miss.
+        *args, **kwargs: the arguments. If any of them cannot be
+            fingerprinted, the function is simply called.
+    Outputs:
+        the (possibly cached) return value. A function may return less
+        when told the shape of the caller's range, so the result is cached
+        under that shape as well; see axl.context.caller_shape().'''
+    try:
+        key = (key, fingerprint(args), fingerprint(sorted(kwargs.items())), context.caller_shape())
+    except TypeError:
+        return func(*args, **kwargs)
+    value = cache.get(key, _missing)
+    if value is _missing:
+        value = func(*args, **kwargs)
+        # A coroutine can be awaited only once, so it is never cached.
+        if not asyncio.iscoroutine(value):
+            cache.put(key, value)
+    return value
@@ -1,7 +1,15 @@
+import os as _os
+import ast as _ast
+import builtins as _builtin_module
+from time import perf_counter as _perf_counter
+from functools import partial as _partial
+from concurrent.futures import wait as _wait, FIRST_COMPLETED as _FIRST_COMPLETED
+
 import numpy as np
 import pandas as pd
 
 from .converters import to_excel
+from . import context as _context
 
 ToExcel = to_excel
 
@@ -52,13 +60,19 @@ def TupleVec(x, arg=0, flatten=False):
 
 
 def Transpose(arr):
-    '''Transposes an Excel input.
+    '''Transposes an Excel input. If the shape of the caller's range is
+    known, only the part of the result that fits in it is computed.
 
     Input:
         arr: the data to convert.
     Output:
         a 2-D Excel array representing the transposed data.'''
-    return tuple(map(tuple, zip(*TupleMat(arr))))
+    arr = TupleMat(arr)
+    shape = _context.caller_shape()
+    if shape is not None and len(set(map(len, arr))) == 1:
+        nr, nc = shape[:2]
+        return tuple(x[:nc] for x in zip(*arr[:nc]))[:nr]
+    return tuple(map(tuple, zip(*arr)))
 
 
 def ColDF(arr, labels=None):
@@ -274,6 +288,29 @@ def Slice(*args):
     return slice(*args)
 
 
+# The array constructors below convert only the part of their input that
+# fits in the caller's range, when that is known. The dtype inferred from
+# part of the input may differ from that of the whole, however, so this
+# is done only if the dtype is given.
+def _shown_rows(arr, dtype):
+    arr = TupleMat(arr)
+    shape = _context.caller_shape()
+    if shape is None or dtype is None:
+        return arr
+    nr, nc = shape[:2]
+    return tuple(x[:nc] for x in arr[:nr]) if len(set(map(len, arr))) == 1 else arr
+
+
+def _vector(arr, flatten, dtype, shown):
+    # shown selects the dimension of the caller's range along which the
+    # vector is laid out: 0 for rows, 1 for columns.
+    vec = TupleVec(arr, arg=0, flatten=flatten)
+    shape = _context.caller_shape()
+    if shape is not None and dtype is not None:
+        vec = vec[:shape[shown]]
+    return np.array(vec, dtype=dtype)
+
+
 def Array(arr, dtype=None):
     '''Converts the input to a 2-D NumPy array.
 
@@ -284,7 +321,7 @@ def Array(arr, dtype=None):
             If not supplied, the dtype will be inferred in the usual manner.
     Output:
         a NumPy array.'''
-    return np.array(TupleMat(arr), dtype=dtype)
+    return np.array(_shown_rows(arr, dtype), dtype=dtype)
 
 
 def Matrix(arr, dtype=None):
@@ -297,7 +334,7 @@ def Matrix(arr, dtype=None):
             If not supplied, the dtype will be inferred in the usual manner.
     Output:
         a NumPy matrix.'''
-    return np.matrix(TupleMat(arr), dtype=dtype)
+    return np.matrix(_shown_rows(arr, dtype), dtype=dtype)
 
 
 def Vector(arr, flatten=False, dtype=None):
@@ -316,7 +353,8 @@ default), raise an Exception if
             If not supplied, the dtype will be inferred in the usual manner.
     Output:
         a NumPy vector.'''
-    return np.array(TupleVec(arr, arg=0, flatten=flatten), dtype=dtype)
+    shape = _context.caller_shape()
+    return _vector(arr, flatten, dtype, 0 if shape is not None and shape[1] == 1 else 1)
 
 
 def Row(arr, flatten=False, dtype=None):
@@ -332,7 +370,7 @@ def Row(arr, flatten=False, dtype=None):
             If not supplied, the dtype will be inferred in the usual manner.
     Output:
         a NumPy vector.'''
-    return Vector(arr, flatten, dtype)[None, :]
+    return _vector(arr, flatten, dtype, 1)[None, :]
 
 
 def Column(arr, flatten=False, dtype=None):
@@ -348,7 +386,372 @@ def Column(arr, flatten=False, dtype=None):
             If not supplied, the dtype will be inferred in the usual manner.
     Output:
         a NumPy vector.'''
-    return Vector(arr, flatten, dtype)[:, None]
+    return _vector(arr, flatten, dtype, 0)[:, None]
+
+
+def _function(func):
+    # Returns the function named by a string in the AXL namespace, or the
+    # argument itself if it is not a string.
+    if type(func) is str:
+        # Imported here, since axl.imports itself imports this module
+        from .imports import resolve
+        func = resolve(func)
+    return func
+
+
+def _operand(arg):
+    # Converts an Excel input to an array for broadcasting. Ranges of
+    # mixed or non-numeric values become object arrays, so that each
+    # element reaches the function unchanged.
+    arr = np.asarray(arg)
+    if arr.dtype.kind in 'USV':
+        arr = np.empty(arr.shape, dtype=object)
+        arr[...] = arg
+    return arr
+
+
+def Map(func, *args, **kwargs):
+    '''Applies a function elementwise to one or more Excel inputs, in a
+    single call. The inputs are broadcast against each other using the
+    NumPy rules; e.g., a column and a row yield a matrix.
+
+    Inputs:
+        func: the function to apply, or its name in the AXL namespace.
+        *args: the inputs; ranges, vectors or scalars.
+    Keywords:
+        vectorized: if True, the function is called once, with the inputs
+            converted to NumPy arrays. If False, it is called once for each
+            element, in a compiled loop. If None (default), NumPy ufuncs are
+            called once, and other functions once for each element.
+        Any other keywords are passed to the function on every call.
+    Output:
+        a NumPy array with the results, of the broadcast shape.'''
+    vectorized = kwargs.pop('vectorized', None)
+    func = _function(func)
+    if not args:
+        raise TypeError('Map requires at least one input')
+    if kwargs:
+        func = _partial(func, **kwargs)
+    arrays = [_operand(arg) for arg in args]
+    if vectorized is None:
+        vectorized = isinstance(func, np.ufunc) and not any(arr.dtype.hasobject for arr in arrays)
+    if vectorized:
+        return np.asarray(func(*arrays))
+    return np.frompyfunc(func, len(arrays), 1)(*arrays)
+
+
+Broadcast = Map
+
+
+def _grid_row(func, x, ys, kwargs):
+    # Evaluates one row of a grid; run in a worker process when the grid
+    # is evaluated in parallel, so the function may be given by name.
+    func = _function(func)
+    if ys is None:
+        return [func(x, **kwargs)]
+    return [func(x, y, **kwargs) for y in ys]
+
+
+def Grid(func, x, y=None, parallel=False, **kwargs):
+    '''Evaluates a function over a grid of parameter values, replacing an
+    Excel Data Table with a single call.
+
+    Inputs:
+        func: the function to evaluate, or its name in the AXL namespace;
+            for instance, a function object saved by another cell, which
+            may bind the remaining inputs of a model with functools.partial.
+        x: a vector of values for the first argument of the function.
+    Keywords:
+        y: a vector of values for the second argument. If omitted, the
+            function takes a single argument.
+        parallel: if True, the rows of the grid are evaluated at the same
+            time in the pool of worker processes; see axl.workers. The
+            function, and the results, must then be picklable.
+        Any other keywords are passed to the function at every point.
+    Output:
+        a NumPy array of the results, with a row for each value of x and,
+        if y is supplied, a column for each value of y.'''
+    xs = TupleVec(x, 'x')
+    ys = None if y is None else TupleVec(y, 'y')
+    if parallel:
+        from . import workers
+        executor = workers.process_pool()
+        futures = [executor.submit(_grid_row, func, xv, ys, kwargs) for xv in xs]
+        rows = [future.result() for future in futures]
+    else:
+        func = _function(func)
+        rows = []
+        for xv in xs:
+            _context.check()
+            rows.append(_grid_row(func, xv, ys, kwargs))
+    result = np.empty((len(xs), 1 if ys is None else len(ys)), dtype=object)
+    for n, row in enumerate(rows):
+        result[n, :] = row
+    return result[:, 0] if ys is None else result
+
+
+_PMAP_PROBE = 64
+_PMAP_SECONDS = 0.05
+_PMAP_MAX = 65536
+
+
+def _pmap_chunk(func, chunk, unpack, kwargs):
+    # Applies a function to the rows of a chunk in a worker process, and
+    # returns the results along with the time taken.
+    start = _perf_counter()
+    func = _function(func)
+    if type(chunk) is pd.DataFrame:
+        chunk = chunk.to_dict('records')
+        if unpack:
+            values = [func(**row, **kwargs) for row in chunk]
+        else:
+            values = [func(row, **kwargs) for row in chunk]
+    elif unpack:
+        values = [func(*row, **kwargs) if type(row) is tuple else func(row, **kwargs) for row in chunk]
+    else:
+        values = [func(row, **kwargs) for row in chunk]
+    return values, _perf_counter() - start
+
+
+def PMap(func, data, chunksize=None, unpack=False, **kwargs):
+    '''Applies a function to each row of a range or DataFrame, in parallel,
+    using the pool of worker processes; see axl.workers. The pool persists
+    between calls, so its start-up cost is paid only once.
+
+    The rows are sent to the workers in chunks. Unless a chunk size is
+    given, the first chunks are small, and the size of the rest is chosen
+    from the time per row measured so far, so that each chunk takes about
+    50 milliseconds: large enough to amortize the cost of sending it, and
+    small enough to keep all workers busy until the end.
+
+    Inputs:
+        func: the function, or its name in the AXL namespace. A function
+            given by name is looked up by each worker; otherwise, it must
+            be picklable, like the rows and the results.
+        data: a range, whose rows are passed as tuples, or a DataFrame,
+            whose rows are passed as dictionaries keyed by column.
+    Keywords:
+        chunksize: a fixed number of rows per chunk.
+        unpack: if True, the elements of each row are passed as separate
+            arguments; by keyword, for the rows of a DataFrame.
+        Any other keywords are passed to the function for every row.
+    Output:
+        a list of the results, one per row, in order.'''
+    from . import workers
+    if type(data) is pd.DataFrame:
+        nrows = len(data.index)
+        take = data.iloc.__getitem__
+    else:
+        data = data if type(data) in (tuple, list) else (data,)
+        nrows = len(data)
+        take = data.__getitem__
+    executor = workers.process_pool()
+    inflight = 2 * (_os.cpu_count() or 1)
+    size = int(chunksize) if chunksize else _PMAP_PROBE
+    per_row = None
+    pending = {}
+    results = {}
+    pos = 0
+    try:
+        while pos < nrows or pending:
+            while pos < nrows and len(pending) < inflight:
+                if not chunksize and per_row is not None:
+                    size = max(1, min(_PMAP_MAX, int(_PMAP_SECONDS / max(per_row, 1e-9))))
+                end = min(nrows, pos + size)
+                pending[executor.submit(_pmap_chunk, func, take(slice(pos, end)), unpack, kwargs)] = pos
+                pos = end
+            done, _ = _wait(pending, timeout=0.1, return_when=_FIRST_COMPLETED)
+            _context.check()
+            for future in done:
+                start = pending.pop(future)
+                values, elapsed = future.result()
+                results[start] = values
+                rate = elapsed / max(1, len(values))
+                per_row = rate if per_row is None else 0.5 * (per_row + rate)
+    finally:
+        for future in pending:
+            future.cancel()
+    return [value for start in sorted(results) for value in results[start]]
+
+
+def _brent(f, a, b, xtol, rtol, maxiter):
+    # Brent's method, after Numerical Recipes' zbrent: inverse quadratic
+    # interpolation, falling back to bisection, within a bracket [a, b].
+    fa, fb = f(a), f(b)
+    if (fa > 0) == (fb > 0) and fa != 0 and fb != 0:
+        raise ValueError('The function must have opposite signs at lo and hi')
+    c, fc = b, fb
+    d = e = b - a
+    for count in range(2, maxiter + 2):
+        _context.check()
+        if (fb > 0) == (fc > 0) and fc != 0:
+            c, fc = a, fa
+            d = e = b - a
+        if abs(fc) < abs(fb):
+            a, b, c = b, c, b
+            fa, fb, fc = fb, fc, fb
+        tol = 2 * rtol * abs(b) + 0.5 * xtol
+        m = 0.5 * (c - b)
+        if abs(m) <= tol or fb == 0:
+            return b, fb, count, True
+        if abs(e) >= tol and abs(fa) > abs(fb):
+            s = fb / fa
+            if a == c:
+                p = 2 * m * s
+                q = 1 - s
+            else:
+                q = fa / fc
+                r = fb / fc
+                p = s * (2 * m * q * (q - r) - (b - a) * (r - 1))
+                q = (q - 1) * (r - 1) * (s - 1)
+            if p > 0:
+                q = -q
+            p = abs(p)
+            if 2 * p < min(3 * m * q - abs(tol * q), abs(e * q)):
+                e = d
+                d = p / q
+            else:
+                d = e = m
+        else:
+            d = e = m
+        a, fa = b, fb
+        b += d if abs(d) > tol else (tol if m > 0 else -tol)
+        fb = f(b)
+    return b, fb, maxiter + 2, False
+
+
+def _secant(f, x0, xtol, rtol, maxiter):
+    # The secant method, from x0 and a point close to it.
+    x1 = x0 * (1 + 1e-4) + (1e-4 if x0 >= 0 else -1e-4)
+    f0, f1 = f(x0), f(x1)
+    calls = 2
+    for n in range(maxiter):
+        _context.check()
+        if f1 == 0:
+            return x1, f1, calls, True
+        if f1 == f0:
+            break
+        x0, f0, x1 = x1, f1, x1 - f1 * (x1 - x0) / (f1 - f0)
+        f1 = f(x1)
+        calls += 1
+        if abs(x1 - x0) <= xtol + rtol * abs(x1):
+            return x1, f1, calls, True
+    return x1, f1, calls, False
+
+
+def Solve(func, x0=None, lo=None, hi=None, target=0.0, xtol=1e-12, rtol=4 * np.finfo(float).eps,
+          maxiter=100, **kwargs):
+    '''Finds an input at which a function equals a target value; by
+    default, a root of the function. The iterations run directly against
+    the Python function, without recalculating Excel.
+
+    Inputs:
+        func: the function, or its name in the AXL namespace; e.g., a model
+            saved by another cell. It is called with the candidate value as
+            its first argument.
+    Keywords:
+        x0: a starting point. Required unless lo and hi are supplied.
+        lo, hi: a bracket of the solution: the function, less the target,
+            must have opposite signs at lo and hi. If supplied, Brent's
+            method is used, and is guaranteed to converge; otherwise, the
+            secant method is used, starting at x0.
+        target: the value the function should attain.
+        xtol, rtol: the absolute and relative tolerances on the solution.
+        maxiter: the maximum number of iterations.
+        Any other keywords are passed to the function at every call.
+    Output:
+        a column containing the solution; the function less the target at
+        the solution; the number of function calls; whether the iterations
+        converged; and the method used ("brent" or "secant"). A single cell
+        thus shows just the solution.'''
+    func = _function(func)
+    target = float(target)
+
+    def f(x):
+        return func(x, **kwargs) - target
+    if lo is not None and hi is not None:
+        method = 'brent'
+        root, residual, count, converged = _brent(f, float(lo), float(hi), xtol, rtol, int(maxiter))
+    elif x0 is not None:
+        method = 'secant'
+        root, residual, count, converged = _secant(f, float(x0), xtol, rtol, int(maxiter))
+    else:
+        raise ValueError('Solve requires either a starting point x0, or a bracket lo and hi')
+    return ((root,), (residual,), (count,), (converged,), (method,))
+
+
+def GoalSeek(func, target, x0=None, lo=None, hi=None, **kwargs):
+    '''Finds an input at which a function attains a target value, like
+    Excel's Goal Seek. Equivalent to Solve(func, x0, lo, hi, target, ...);
+    see Solve() for the keywords and the output.'''
+    return Solve(func, x0, lo, hi, target, **kwargs)
+
+
+_MAX_EXPRESSIONS = 256
+_expressions = {}
+_builtins = {name: getattr(_builtin_module, name) for name in
+             ('abs', 'all', 'any', 'bool', 'divmod', 'float', 'int', 'len', 'list', 'max',
+              'min', 'pow', 'range', 'round', 'sorted', 'str', 'sum', 'tuple', 'zip')}
+
+
+def _compile(expr, names):
+    # Compiles an expression, and gathers the namespace it is evaluated in:
+    # the symbols it uses from the AXL namespace, and a few builtins. Names
+    # beginning with an underscore are rejected. This keeps mistakes out,
+    # not malice: an expression can do anything the imported modules can,
+    # so Eval is no more a sandbox than any other imported function.
+    from .imports import _imports
+    tree = _ast.parse(expr.strip(), mode='eval')
+    used, bound = set(), set(names)
+    for node in _ast.walk(tree):
+        if isinstance(node, _ast.Name):
+            name = node.id
+            (used if isinstance(node.ctx, _ast.Load) else bound).add(name)
+        elif isinstance(node, _ast.Attribute):
+            name = node.attr
+        else:
+            continue
+        if name.startswith('_'):
+            raise ValueError('Names beginning with an underscore are not allowed: {}'.format(name))
+    namespace = {'__builtins__': {}}
+    for name in used - bound:
+        if name in _imports.__dict__:
+            namespace[name] = _imports.__dict__[name]
+        elif name in _builtins:
+            namespace[name] = _builtins[name]
+        else:
+            raise NameError("Name '{}' is not an argument, nor in the AXL namespace".format(name))
+    return compile(tree, '<Eval>', 'eval'), namespace
+
+
+def Eval(expr, **kwargs):
+    '''Evaluates an arithmetic or NumPy expression over named inputs; e.g.,
+    "np.log(x) * w + b". The expression is compiled once, and reused for
+    every cell that evaluates it with the same argument names.
+
+    Inputs:
+        expr: the expression. It may refer to its arguments, the symbols
+            of the AXL namespace, and a few builtins such as abs, min and
+            max; names beginning with an underscore are not allowed. The
+            expression runs with the full rights of the server, like any
+            imported function.
+    Keywords:
+        The named inputs. Excel ranges are converted to NumPy arrays, so
+        that operators apply elementwise.
+    Output:
+        the value of the expression.'''
+    key = (expr, tuple(sorted(kwargs)))
+    entry = _expressions.get(key)
+    if entry is None:
+        entry = _compile(expr, key[1])
+        if len(_expressions) >= _MAX_EXPRESSIONS:
+            _expressions.clear()
+        _expressions[key] = entry
+    code, namespace = entry
+    namespace = dict(namespace)
+    for name, value in kwargs.items():
+        namespace[name] = _operand(value) if type(value) is tuple else value
+    return eval(code, namespace)
 
 
 def Echo(*args):
@@ -423,9 +826,30 @@ def DFColNames(obj):
     return obj.columns
 
 
+def _top_rows(obj, key, ascending, count):
+    # Returns the rows of obj that can be among the first count once it is
+    # sorted by key, first of all: every row up to the count-th smallest
+    # (or largest) key, ties included, in their original order. Missing
+    # values sort last, and are never needed if there are enough others.
+    values = obj[key]
+    if type(values) is not pd.Series or values.dtype.kind not in 'iuf' or count >= len(obj):
+        return obj
+    if count == 0:
+        return obj.iloc[:0]
+    # Some versions of pandas fill out the result with missing values.
+    present = values.dropna()
+    top = present.nsmallest(count) if ascending else present.nlargest(count)
+    if len(top) < count:
+        return obj
+    bound = top.iloc[-1]
+    return obj[(values <= bound if ascending else values >= bound).values]
+
+
 def DFCols(obj, columns=None, exclude=None, sortby=None, ascending=True):
     '''Retrieves a portion of a Pandas DataFrame for display in Excel, including
-    the ability to sort by one or more columns.
+    the ability to sort by one or more columns. If the shape of the caller's
+    range is known, only the rows and columns that fit in it are retrieved,
+    and those rows are found without sorting the whole DataFrame.
 
     Inputs:
         obj: a Pandas DataFrame.
@@ -458,6 +882,13 @@ def DFCols(obj, columns=None, exclude=None, sortby=None, ascending=True):
     if exclude is not None:
         exclude = set(TupleVec(exclude, arg='exclude'))
         columns = [x for x in columns if x not in exclude]
+    shape = _context.caller_shape()
+    count = None
+    shown = columns
+    if shape is not None and obj.columns.is_unique:
+        nr, nc, headers = shape
+        count = max(0, nr - 1) if headers else nr
+        shown = columns[:nc]
     dropped = False
     if sortby is not None:
         sortby = TupleVec(sortby, arg='sortby', flatten=True)
@@ -465,9 +896,15 @@ def DFCols(obj, columns=None, exclude=None, sortby=None, ascending=True):
         if any(x in columns for x in inames):
             obj = obj.reset_index()
             dropped = True
-        # To avoid an otherwise unnecessary Pandas version restriction
+        if count is not None and sortby and sortby[0] in obj.columns:
+            obj = _top_rows(obj, sortby[0], ascending[0], count)
+        # To avoid an otherwise unnecessary Pandas version restriction.
+        # The sort is stable, so that rows with equal keys appear in the
+        # same order whether or not the caller's shape was used.
         sfunc = getattr(obj, 'sort_values', 'sort')
-        obj = sfunc(list(sortby), ascending=list(ascending))
+        obj = sfunc(list(sortby), ascending=list(ascending), kind='mergesort')
+    if count is not None:
+        obj = obj.iloc[:count]
     if not dropped:
         obj = obj.reset_index()
-    return obj[columns]
+    return obj[shown]
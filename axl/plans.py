@@ -0,0 +1,257 @@
+'''Compiled call plans for the command loop.
+
+A queue sent by Excel is a sequence of commands, each consisting of a
+command name followed by its arguments, and terminated by the address
+of the calling cell. Interpreting a command means locating its stack
+references ("!$n") and keyword markers ("name="), and looking up the
+function it names. None of this depends on the values of the remaining
+arguments, so the result is compiled into a plan, cached under the
+structure of the queue, and reused whenever the same formula shape is
+calculated again.'''
+
+import threading
+from functools import partial
+
+from .converters import from_excel
+from .imports import resolve, symbol_options
+from . import methods, workers, memo, errors, fusion
+
+LOCAL, METHOD, ATTR, IMPORT = range(4)
+# The methods that call functions supplied by the user, any number of
+# times, and so are subject to the default time budget like them.
+BUDGETED = frozenset(('Map', 'Grid', 'PMap', 'Solve', 'GoalSeek', 'Eval'))
+
+MAX_PLANS = 1024
+_plans = {}
+_lock = threading.Lock()
+
+
+class Step(object):
+    '''A single compiled command.
+
+    Attributes:
+        name: the command name, without its prefix character.
+        kind: LOCAL ("%" prefix), METHOD ("@"), ATTR (".") or IMPORT.
+        target: the function to call. For ATTR commands, this is instead
+            the tuple of attribute names to follow from the first argument.
+            None if the lookup failed; in that case the lookup is repeated
+            when the step is run, so the error is reported in context.
+            For imported functions marked with the "process" option, this
+            is a function that forwards the call to the process pool; for
+            those declared pure, one that consults the memo cache first.
+        args: a tuple of (is_ref, index) pairs, one per positional argument.
+            If is_ref is True, index selects an earlier result; otherwise,
+            it selects a position in the command's own argument list.
+        kwargs: a tuple of (key, is_ref, index) triples, one per keyword.
+        refs: the indices of the earlier results the command refers to.
+        error: None, or a (message, detail) pair describing a parse error
+            to be returned in place of running the command.
+        volatile: True if the command may return different results when
+            given the same arguments.
+        timeout: the time budget for the command, in seconds, as given by
+            the "timeout" option in the imports files; or None.'''
+    __slots__ = ('name', 'kind', 'target', 'args', 'kwargs', 'refs', 'error', 'volatile', 'timeout')
+
+    def lookup(self):
+        '''Looks up the function named by the command, raising an exception
+        if it does not exist.'''
+        if self.kind == METHOD:
+            return getattr(methods, self.name)
+        obj = func = resolve(self.name)
+        options = symbol_options(self.name)
+        if options.get('process'):
+            func = partial(workers.call_in_process, self.name)
+        if options.get('pure') or getattr(obj, '_axl_pure', False):
+            func = partial(memo.call, obj, func)
+        return func
+
+    def parse_error(self, cmd, values):
+        '''Returns the error code for a command that failed to parse; see
+        axl.errors.
+
+        Inputs:
+            cmd: the original command, including its name.
+            values: the results of the commands run so far.'''
+        message, detail = self.error
+        if message == 'keyword':
+            ref, ndx = detail
+            arg = values[ndx] if ref else from_excel(cmd[ndx + 1])
+            summary = '{}: expected a keyword string, found {!r}'.format(cmd[0], arg)
+            text = '''#PYTHON?
+                        Error encountered parsing Python function "{}":
+                        Expected a keyword string, found this: {}'''.format(cmd[0], repr(arg))
+        else:
+            summary = '{}: missing argument value for keyword "{}"'.format(cmd[0], detail)
+            text = '''#PYTHON?
+                    Error encountered parsing Python function "{}":
+                    Missing argument value for keyword "{}"'''.format(cmd[0], detail)
+        return errors.report_text(summary, text)
+
+
+def compile_command(cmd):
+    '''Compiles a single command of a queue into a Step.'''
+    cmd_name = cmd[0]
+    step = Step()
+    step.error = None
+    args = []
+    kwargs = []
+    key = None
+    for ndx, arg in enumerate(cmd[1:]):
+        tstr = type(arg) is str
+        if tstr and arg[:2] == '!$':
+            spec = (True, int(arg[2:]))
+            tstr = False
+        else:
+            spec = (False, ndx)
+        if key is not None:
+            kwargs.append((key,) + spec)
+            key = None
+        elif tstr and arg[-1:] == '=':
+            key = arg[:-1]
+        elif kwargs:
+            step.error = ('keyword', spec)
+            break
+        else:
+            args.append(spec)
+    if key is not None and step.error is None:
+        step.error = ('missing', key)
+    step.args = tuple(args)
+    step.kwargs = tuple(kwargs)
+    step.refs = tuple(n for ref, n in args if ref) + tuple(n for key, ref, n in kwargs if ref)
+    step.volatile = False
+    step.timeout = None
+    prefix = cmd_name[:1]
+    if prefix == '%':
+        step.kind, step.name = LOCAL, cmd_name[1:]
+    elif prefix == '@':
+        step.kind, step.name = METHOD, cmd_name[1:]
+    elif prefix == '.':
+        step.kind, step.name = ATTR, cmd_name[1:]
+    else:
+        step.kind, step.name = IMPORT, cmd_name
+    if step.kind == ATTR:
+        step.target = tuple(step.name.split('.'))
+    elif step.kind == LOCAL:
+        step.target = None
+    else:
+        try:
+            step.target = step.lookup()
+        except Exception:
+            step.target = None
+    if step.kind == IMPORT:
+        step.timeout = symbol_options(step.name).get('timeout')
+        try:
+            step.volatile = bool(symbol_options(step.name).get('volatile') or
+                                 getattr(resolve(step.name), '_axl_volatile', False))
+        except Exception:
+            pass
+    return step
+
+
+class Plan(object):
+    '''The compiled form of a queue.
+
+    Attributes:
+        steps: a tuple of Steps, one per command, excluding the trailing
+            caller address.
+        background: True if the queue may run off the COM server thread;
+            that is, it has no local commands with side effects. (Load
+            is the only local command that qualifies.)
+        waves: the steps grouped for parallel evaluation. Each wave holds
+            the steps whose inputs are all produced by earlier waves, split
+            into an (inline, offload) pair of index tuples. The offload
+            steps are sent to worker threads; the inline steps, which are
+            cheap or would otherwise leave the caller idle, are not.
+        parallel: True if any wave has steps to offload, and the queue is
+            otherwise eligible for parallel evaluation.
+        loads: the indices of the Load steps.
+        reusable: True if the result of the queue is determined by the
+            queue itself and by the objects it loads, so that it may be
+            reused when an identical queue is sent again.
+        fused: None, or a function that computes the result of the whole
+            queue at once; see axl.fusion.
+        shaped: the index of the step whose result is returned to Excel
+            by a final ToExcel command, and used by no other command; or
+            None. That step is told the shape of the caller's range; see
+            axl.context.caller_shape().'''
+    __slots__ = ('steps', 'background', 'waves', 'parallel', 'loads', 'reusable', 'fused', 'shaped')
+
+    def __init__(self, steps):
+        self.steps = steps
+        self.background = all(step.kind != LOCAL or step.name == 'Load' for step in steps)
+        levels = []
+        ordered = True
+        for ndx, step in enumerate(steps):
+            ordered = ordered and all(n < ndx for n in step.refs)
+            levels.append(1 + max([levels[n] for n in step.refs if n < ndx] or [-1]))
+        waves = []
+        for level in range(max(levels) + 1 if levels else 0):
+            wave = [ndx for ndx, lev in enumerate(levels) if lev == level]
+            heavy = [ndx for ndx in wave if steps[ndx].kind in (IMPORT, ATTR)]
+            inline = tuple(ndx for ndx in wave if ndx not in heavy[1:])
+            waves.append((inline, tuple(heavy[1:])))
+        self.waves = tuple(waves)
+        self.parallel = (ordered and self.background and
+                         all(step.error is None for step in steps) and
+                         any(offload for inline, offload in waves))
+        self.loads = tuple(ndx for ndx, step in enumerate(steps) if step.kind == LOCAL and step.name == 'Load')
+        self.reusable = (self.background and
+                         all(step.error is None and not step.volatile for step in steps) and
+                         all(steps[ndx].args[:1] == ((False, 0),) for ndx in self.loads))
+        self.fused = fusion.match(steps)
+        self.shaped = None
+        last = steps[-1] if steps else None
+        if (last is not None and last.kind == METHOD and last.name == 'ToExcel' and last.error is None and
+                not last.kwargs and len(last.args) in (3, 4) and last.args[0][0] and
+                not any(ref for ref, n in last.args[1:])):
+            ndx = last.args[0][1]
+            if (0 <= ndx < len(steps) - 1 and steps[ndx].kind != LOCAL and
+                    sum(step.refs.count(ndx) for step in steps) == 1):
+                self.shaped = ndx
+
+    def shape(self, queue):
+        '''Returns the shape of the caller's range, as given to the final
+        ToExcel command of a queue, in the form returned by
+        axl.context.caller_shape(); or None.'''
+        if self.shaped is None:
+            return None
+        cmd_args = queue[len(self.steps) - 1][1:]
+        try:
+            nr, nc = int(cmd_args[1]), int(cmd_args[2])
+        except (TypeError, ValueError):
+            return None
+        if nr < 0 or nc < 0:
+            return None
+        return nr, nc, bool(from_excel(cmd_args[3])) if len(cmd_args) > 3 else True
+
+    def sources(self, queue):
+        '''Returns the addresses of the objects loaded by a queue.'''
+        return tuple(queue[ndx][1] for ndx in self.loads)
+
+
+def structure(queue):
+    '''Returns the structure of a queue: the command names, along with the
+    stack references and keyword markers found among their arguments. Two
+    queues with the same structure compile to the same plan.'''
+    key = []
+    for cmd in queue[:-1]:
+        key.append(len(cmd))
+        key.append(cmd[0])
+        for arg in cmd[1:]:
+            key.append(arg if type(arg) is str and (arg[:2] == '!$' or arg[-1:] == '=') else None)
+    return tuple(key)
+
+
+def compile_queue(queue):
+    '''Returns the Plan for a queue, compiling it if necessary.'''
+    key = structure(queue)
+    plan = _plans.get(key)
+    if plan is None:
+        # Two threads may compile the same plan at once; either result
+        # will do, so compilation itself is not serialized.
+        plan = Plan(tuple(map(compile_command, queue[:-1])))
+        with _lock:
+            if len(_plans) >= MAX_PLANS:
+                _plans.clear()
+            plan = _plans.setdefault(key, plan)
+    return plan
@@ -0,0 +1,297 @@
+'''Pools of long-lived resources, such as database connections, open
+files or HTTP sessions, for use by imported functions.
+
+Opening a connection often costs far more than the query a cell makes
+with it. Instead, a function may borrow a connection from a named pool,
+and return it for the next caller:
+
+    from axl.resources import borrow
+
+    def revenue(region):
+        with borrow('warehouse') as conn:
+            return conn.execute('select sum(amount) from sales where region = ?', (region,)).fetchone()[0]
+
+Pools are created on first use, persist for the life of the server, and
+are shared by all threads; each process of the process pool has pools of
+its own. A pool is either registered in code, with register(), or
+described in a resources file alongside the imports files; see
+tools/resources.EXAMPLE. Resources idle for too long are closed, and a
+resource that has not been used for a while is checked before it is
+lent out again.'''
+
+import os
+import sys
+import ast
+import glob
+import threading
+import importlib
+import configparser
+from time import monotonic
+from contextlib import contextmanager
+
+SIZE = 4
+IDLE = 300
+CHECK_INTERVAL = 30
+WAIT = 30
+
+_lock = threading.Lock()
+_pools = {}
+_config = {}
+
+
+class ResourceError(RuntimeError):
+    '''Raised when a resource cannot be obtained from its pool.'''
+
+
+def _locate(path):
+    # Returns the object named by a dotted path, importing its module.
+    parts = path.split('.')
+    for n in range(len(parts) - 1, 0, -1):
+        try:
+            obj = importlib.import_module('.'.join(parts[:n]))
+        except ImportError:
+            continue
+        for part in parts[n:]:
+            obj = getattr(obj, part)
+        return obj
+    raise ImportError('Cannot locate {!r}'.format(path))
+
+
+class Pool(object):
+    '''A bounded pool of interchangeable resources.
+
+    Inputs:
+        name: the name of the pool.
+        factory: a function that creates a new resource.
+        args, kwargs: the arguments to pass to the factory.
+    Keywords:
+        size: the maximum number of resources open at once.
+        idle: the number of seconds after which an unused resource is
+            closed.
+        check: the name of a method of the resource to call before lending
+            it out, if it has not been used for check_interval seconds; if
+            the call fails, the resource is closed and replaced. If None,
+            resources are not checked.
+        check_args: the arguments to pass to the check method.
+        check_interval: see check.
+        close: the name of the method that closes a resource, if any.
+        wait: the number of seconds to wait for a resource when all of
+            them are in use, before giving up.'''
+
+    def __init__(self, name, factory, args=(), kwargs=None, size=SIZE, idle=IDLE, check=None,
+                 check_args=(), check_interval=CHECK_INTERVAL, close='close', wait=WAIT):
+        self.name = name
+        self.factory = factory
+        self.args = tuple(args)
+        self.kwargs = dict(kwargs or {})
+        self.size = size
+        self.idle = idle
+        self.check = check
+        self.check_args = tuple(check_args)
+        self.check_interval = check_interval
+        self.close = close
+        self.wait = wait
+        # The free resources, with the time each was last returned and
+        # whether it must be checked; the most recently returned is lent
+        # out first, so the others age.
+        self.free = []
+        self.open = 0
+        self.created = self.reused = self.evicted = self.failed = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        '''Lends out a resource, creating one if none is free.
+
+        Raises:
+            ResourceError, if all resources remain in use for wait seconds.'''
+        deadline = monotonic() + self.wait
+        while True:
+            with self.cond:
+                expired = self._expired()
+                while not self.free and self.open >= self.size:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        raise ResourceError('All {} resources of pool "{}" are in use'.format(self.size, self.name))
+                    self.cond.wait(remaining)
+                if self.free:
+                    resource, last_used, suspect = self.free.pop()
+                else:
+                    resource = None
+                    self.open += 1
+            self._close_all(expired)
+            if resource is None:
+                return self._create()
+            if (self.check is None or not suspect and monotonic() - last_used < self.check_interval or
+                    self._healthy(resource)):
+                with self.cond:
+                    self.reused += 1
+                return resource
+            with self.cond:
+                self.failed += 1
+            self.discard(resource)
+
+    def release(self, resource, suspect=False):
+        '''Returns a resource to the pool. If suspect is True, it is checked
+        before it is lent out again.'''
+        with self.cond:
+            self.free.append((resource, monotonic(), suspect))
+            expired = self._expired()
+            self.cond.notify()
+        self._close_all(expired)
+
+    def discard(self, resource):
+        '''Closes a resource that was lent out, rather than returning it.'''
+        with self.cond:
+            self.open -= 1
+            self.cond.notify()
+        self._close(resource)
+
+    def clear(self):
+        '''Closes all the free resources. Those lent out are unaffected.'''
+        with self.cond:
+            expired, self.free = self.free, []
+            self.open -= len(expired)
+            self.evicted += len(expired)
+            self.cond.notify_all()
+        self._close_all(expired)
+
+    def stats(self):
+        '''Returns the name, size, open, free, created, reused, evicted and
+        failed counts of the pool, as a table row.'''
+        with self.cond:
+            return (self.name, self.size, self.open, len(self.free),
+                    self.created, self.reused, self.evicted, self.failed)
+
+    def _create(self):
+        try:
+            resource = self.factory(*self.args, **self.kwargs)
+        except BaseException:
+            with self.cond:
+                self.open -= 1
+                self.cond.notify()
+            raise
+        with self.cond:
+            self.created += 1
+        return resource
+
+    def _expired(self):
+        # Removes the resources idle for too long; the caller closes them
+        # once it has released the lock. The free list is in order of use.
+        now = monotonic()
+        n = 0
+        while n < len(self.free) and now - self.free[n][1] > self.idle:
+            n += 1
+        expired, self.free[:n] = self.free[:n], []
+        self.open -= n
+        self.evicted += n
+        return expired
+
+    def _healthy(self, resource):
+        try:
+            getattr(resource, self.check)(*self.check_args)
+            return True
+        except Exception:
+            return False
+
+    def _close(self, resource):
+        close = getattr(resource, self.close, None) if self.close else None
+        if close is not None:
+            try:
+                close()
+            except Exception:
+                pass
+
+    def _close_all(self, entries):
+        for resource, last_used, suspect in entries:
+            self._close(resource)
+
+
+def register(name, factory, *args, **kwargs):
+    '''Registers a pool of resources, replacing any pool of the same name.
+
+    Inputs:
+        name: the name of the pool.
+        factory: a function that creates a new resource, or its dotted
+            name; e.g., "sqlite3.connect".
+        *args: the arguments to pass to the factory.
+    Keywords:
+        kwargs: the keyword arguments to pass to the factory.
+        Any other keywords are passed to Pool; e.g., size, idle, check.'''
+    if isinstance(factory, str):
+        factory = _locate(factory)
+    new_pool = Pool(name, factory, args, **kwargs)
+    with _lock:
+        old_pool = _pools.get(name)
+        _pools[name] = new_pool
+    if old_pool is not None:
+        old_pool.clear()
+    return new_pool
+
+
+def pool(name):
+    '''Returns the pool with the given name, creating it from its
+    description in the resources files on first use.'''
+    found = _pools.get(name)
+    if found is None:
+        with _lock:
+            found = _pools.get(name)
+            if found is None:
+                if name not in _config:
+                    raise KeyError('No resource pool named "{}"'.format(name))
+                options = dict(_config[name])
+                factory = _locate(options.pop('factory'))
+                args = options.pop('args', ())
+                found = _pools[name] = Pool(name, factory, args, **options)
+    return found
+
+
+@contextmanager
+def borrow(name):
+    '''Borrows a resource from a pool for the duration of a with block. If
+    the block raises an exception, the resource is returned nonetheless,
+    but checked before it is lent out again.'''
+    lender = pool(name)
+    resource = lender.acquire()
+    try:
+        yield resource
+    except BaseException:
+        lender.release(resource, suspect=True)
+        raise
+    lender.release(resource)
+
+
+def stats():
+    '''Returns the statistics of every pool created so far; see Pool.stats().'''
+    with _lock:
+        pools = sorted(_pools.items())
+    return tuple(found.stats() for name, found in pools)
+
+
+def clear():
+    '''Closes all the free resources of every pool.'''
+    with _lock:
+        pools = list(_pools.values())
+    for found in pools:
+        found.clear()
+
+
+def parse_config(text):
+    '''Parses the contents of a resources file, adding the pools it
+    describes to those that can be created on demand.'''
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.read_string(text)
+    for name in parser.sections():
+        options = {}
+        for key, value in parser.items(name):
+            if key not in ('factory', 'check', 'close'):
+                value = ast.literal_eval(value)
+            options[key] = value
+        if 'factory' not in options:
+            raise RuntimeError('Resource pool "{}" has no factory'.format(name))
+        _config[name] = options
+
+
+resource_glob = os.path.join(sys.prefix, 'Tools', 'axl', 'resources.*')
+for fname in glob.glob(resource_glob):
+    with open(fname) as fp:
+        parse_config(fp.read())
@@ -1,26 +1,60 @@
 from sys import argv, exc_info
-from traceback import format_tb
-from pywintypes import IID
-
-import win32com.client
-import win32com.server.util
-import win32com.server.dispatcher
-import win32com.server.policy
-import win32api
-import pythoncom
+from itertools import count
+from collections import deque
+from time import monotonic
+from concurrent.futures import Future, TimeoutError
+from inspect import iscoroutine
+import threading
 import re
 
 from .converters import from_excel
-from .imports import _imports
-from . import methods
+from . import plans, workers, memo, errors, store, aio, resources, methods, fusion, context
+
+PENDING = '#PENDING:'
+TICKET_SECONDS = 600
+_missing = object()
+
+
+def format_exception(cmd_name):
+    '''Returns the error code for the exception currently being handled;
+    see axl.errors.'''
+    etype, value, tb = exc_info()
+    if etype is workers.Timeout:
+        return errors.report_text('{}: Timeout: {}'.format(cmd_name, value), '''#PYTHON?
+                    Timeout executing Python function {}:
+                        {}'''.format(cmd_name, str(value)))
+    return errors.report_exception(cmd_name, etype, value, tb)
+
 
 class CommandLoop(object):
-    _public_methods_ = ['Call']
-    _local_methods = ['Log', 'Save', 'Load']
+    _public_methods_ = ['Call', 'CallMany', 'Poll', 'Collect']
+    _local_methods = ['Log', 'Save', 'SaveParts', 'Load', 'Options', 'Limit', 'Memo', 'Stats', 'Error',
+                      'Sessions', 'DropSession', 'CacheStats', 'Resources']
 
-    log_ = []
-    dolog_ = False
-    cache_ = {}
+    # State shared by all instances, i.e., by all the workbooks connected
+    # to this server. Each structure is guarded by its own lock, so that
+    # Call() may run on several threads at once.
+    store_ = store.SessionStore()
+    versions_ = store_.versions
+    burst_ = memo.Burst()
+    inflight_ = {}
+    counts_ = {'calls': 0, 'running': 0, 'reused': 0, 'coalesced': 0}
+    lock_ = threading.Lock()
+
+    def __init__(self):
+        # State owned by the instance, i.e., by one connected workbook,
+        # and guarded by session_lock_.
+        self.log_ = []
+        self.dolog_ = False
+        self.options_ = {'background': False, 'coalesce': True, 'fuse': True, 'parallel': False, 'reuse': False,
+                         'share': False, 'timeout': None}
+        self.results_ = {}
+        self.pending_ = {}
+        self.tickets_ = count(1)
+        self.callers_ = {}
+        self.finished_ = deque()
+        self.called_ = 0.0
+        self.session_lock_ = threading.Lock()
 
     def Log(self, *args):
         '''Activates/deactivates logging, and returns the log output.
@@ -32,13 +66,14 @@ class CommandLoop(object):
             A list of all commands issued since the last call to Log(),
             represented as a string. If logging has not been taking place,
             the string 'None' is returned.'''
-        if self.dolog_:
-            ans = "\n".join(self.log_)
-            self.log_ = []
-        else:
-            ans = ''
-        if args and args[0] is not None:
-            self.dolog_ = bool(args[0])
+        with self.session_lock_:
+            if self.dolog_:
+                ans = "\n".join(self.log_)
+                self.log_ = []
+            else:
+                ans = ''
+            if args and args[0] is not None:
+                self.dolog_ = bool(args[0])
         return ans
 
     def Save(self, addr, obj):
@@ -46,8 +81,41 @@ class CommandLoop(object):
 
         Inputs:
             addr: the address of the Excel cell where this data is "saved".
-            obj: the Python object to save.'''
-        self.cache_[addr] = obj
+            obj: the Python object to save.
+        Raises:
+            axl.store.QuotaExceeded, if the object would take the session of
+            its workbook over quota; see Sessions().'''
+        self.store_.save(addr, obj)
+
+    def SaveParts(self, addr, obj, parts, targets=None):
+        '''Saves an object, and several of its components, each under an
+        address of its own; e.g., the coefficients, residuals and
+        diagnostics of a single regression. Dependent cells may then load
+        any of the components without computing the object again.
+
+        Inputs:
+            addr: the address of the Excel cell where this data is "saved".
+            obj: the Python object to save.
+            parts: a vector of the components to save: dictionary keys,
+                sequence indices, or attribute names.
+        Keywords:
+            targets: a vector of the addresses under which to save the
+                components. If omitted, each component is saved under the
+                address of the object followed by "|" and the component;
+                e.g., "[Book1.xlsx]Sheet1!$A$1|params".
+        Raises:
+            axl.store.QuotaExceeded; see Save().'''
+        parts = methods.TupleVec(parts, 'parts', flatten=True)
+        if targets is None:
+            targets = [store.part_address(addr, part) for part in parts]
+        else:
+            targets = methods.TupleVec(targets, 'targets', flatten=True)
+            if len(targets) != len(parts):
+                raise ValueError('Expected the same number of parts and targets')
+        values = [store.component(obj, part) for part in parts]
+        self.store_.save(addr, obj)
+        for target, value in zip(targets, values):
+            self.store_.save(target, value)
 
     def Load(self, addr):
         '''Loads the specified object from the Excel cache.
@@ -59,109 +127,643 @@ class CommandLoop(object):
             object, None is returned. No errors are returned in this case,
             because a failure to find an object may be due to an out-of-order
             calculation by Excel. By silently failing, Excel allows the full
-            recalculation to eventually complete.'''
-        return self.cache_.get(addr)
+            recalculation to eventually complete.
+        Raises:
+            axl.store.Evicted, if the object was evicted to keep the saved
+            objects within their limits; see CacheStats().'''
+        return self.store_.load(addr)
+
+    def Sessions(self, quota=_missing, name=None):
+        '''Manages the sessions into which saved objects are grouped, one per
+        workbook, and returns their statistics.
+
+        Keywords:
+            quota: if supplied, the new limit on the total size of the
+                objects in a session, in bytes; None for no limit.
+            name: the workbook whose quota is changed. If None or omitted,
+                the quota of every session, present and future, is changed.
+        Outputs:
+            The name, object count, total size and quota of each session,
+            as a table.'''
+        if quota is not _missing:
+            self.store_.set_quota(None if quota is None else int(quota), name)
+        return self.store_.stats()
+
+    def CacheStats(self, max_bytes=_missing, warm_bytes=_missing, cold_bytes=_missing):
+        '''Manages the limits on the memory and disk space used by saved
+        objects, and returns the statistics of the store. Objects beyond
+        the limit of the hot tier, which holds them in memory as they are,
+        are compressed into the warm tier, then spilled to disk in the
+        cold tier, and finally evicted; see axl.store.
+
+        Keywords:
+            max_bytes: if supplied, the new limit on the hot tier, in bytes;
+                None for no limit.
+            warm_bytes, cold_bytes: likewise, for the warm and cold tiers;
+                0 disables a tier.
+        Outputs:
+            The number of objects, total size and limit of each tier, and
+            the counts of hits (overall, and from the warm and cold tiers),
+            misses, promotions, demotions and evictions, and the total size
+            evicted, as a two-column table.'''
+        for limit, tier in ((max_bytes, store.HOT), (warm_bytes, store.WARM), (cold_bytes, store.COLD)):
+            if limit is not _missing:
+                self.store_.resize(None if limit is None else int(limit), tier)
+        return self.store_.totals()
+
+    def DropSession(self, name):
+        '''Removes all the objects saved by a workbook, freeing their memory.
+        This is meant to be called when the workbook is closed.
+
+        Inputs:
+            name: the name of the workbook, as it appears in brackets in
+                external cell addresses; e.g., "Book1.xlsx".
+        Outputs:
+            The number of objects removed, and their total size in bytes.'''
+        with self.session_lock_:
+            for caller in [caller for caller in self.results_ if store.session_of(caller) == name]:
+                del self.results_[caller]
+        return self.store_.drop(name)
+
+    def Resources(self, clear=False):
+        '''Returns the statistics of the pools of resources borrowed by
+        imported functions; see axl.resources.
+
+        Keywords:
+            clear: if True, the free resources of every pool are closed.
+        Outputs:
+            A table with a row for each pool: its name, size, and the
+            numbers of open, free, created, reused, evicted and failed
+            resources.'''
+        if clear:
+            resources.clear()
+        return (('name', 'size', 'open', 'free', 'created', 'reused', 'evicted', 'failed'),) + resources.stats()
+
+    def Options(self, **kwargs):
+        '''Changes the behavior of the command loop.
+
+        Keywords:
+            background: if True, Call() and CallMany() submit each queue to
+                a pool of worker threads and return a pending marker at once;
+                the results are retrieved with Poll() or Collect(), or by
+                calling again from the same caller, as the VBA module does
+                once a second for cells showing the marker. Results not
+                retrieved within TICKET_SECONDS of finishing are discarded.
+                Queues with local commands other than Load always run
+                immediately. A call that follows another closely, as in a
+                recalculation, runs on a separate pool of threads from one
+                that does not, as after an edit; see axl.workers.
+            coalesce: if True (the default), a queue identical to one still
+                running, in background mode or when called from several
+                threads, waits for that one's result rather than being
+                evaluated again; see Stats().
+            fuse: if True (the default), known chains of commands, such as
+                ColDF, DFCols and ToExcel, are run as a single operation
+                that computes only what is shown; see axl.fusion. The
+                result is the same either way; turn this off to debug.
+            parallel: if True, the commands within a queue that do not
+                depend on each other (through "!$" references) are run at
+                the same time on worker threads. This benefits functions
+                that release the GIL, such as I/O or NumPy-heavy code. The
+                imported functions involved must be thread-safe.
+            reuse: if True, the result computed for each caller is kept,
+                and returned again if the caller sends an identical queue,
+                provided none of the objects the queue loads have been saved
+                again since. Queues calling a volatile function, or a local
+                command other than Load, are always recomputed.
+            share: if True, identical commands in the cells of a single
+                recalculation burst are computed once, and their results
+                shared; see axl.memo.Burst. Commands calling methods of
+                objects, or volatile functions, are never shared.
+            timeout: the default time budget, in seconds, for each call to an
+                imported function or a method of an object, and to the
+                methods that call functions, such as Grid, PMap and Solve;
+                None for no limit. The "timeout" option in the imports files sets the
+                budgets of individual functions. A call that overruns is
+                abandoned, and a distinct timeout error is returned.
+        Outputs:
+            The current settings, as a two-column table.'''
+        for key in kwargs:
+            if key not in self.options_:
+                raise KeyError('Unknown option: {}'.format(key))
+        with self.session_lock_:
+            self.options_.update(kwargs)
+            return tuple(sorted(self.options_.items()))
+
+    def Limit(self, name, count=None):
+        '''Limits the number of concurrent background calls to a function.
+        Background calls beyond the limit wait for their turn without
+        taking a worker thread; see axl.workers.submit().
+
+        Inputs:
+            name: the function name, exactly as it appears in formulas.
+            count: the maximum number of simultaneous calls. If None or
+                omitted, the function is no longer limited.'''
+        workers.set_limit(name, count)
+
+    def Memo(self, max_bytes=None, clear=False):
+        '''Manages the cache of results of pure functions, and returns its
+        statistics, along with those of the results shared within bursts.
+
+        Keywords:
+            max_bytes: if supplied, the new limit on the total size of the
+                cached results, in bytes.
+            clear: if True, the cache is emptied.
+        Outputs:
+            The number of entries, their total size, the size limit, and
+            the hit, miss and eviction counts, as a two-column table.
+            The table ends with the hit and miss counts for shared results.'''
+        if clear:
+            memo.cache.clear()
+        if max_bytes is not None:
+            memo.cache.resize(int(max_bytes))
+        return memo.cache.stats() + (('shared_hits', self.burst_.hits), ('shared_misses', self.burst_.misses))
+
+    def Stats(self):
+        '''Returns counters describing the activity of the command loop.
+
+        Outputs:
+            A two-column table with the number of queues evaluated (calls),
+            the number currently running (running), the number answered
+            with the stored result of an identical earlier queue (reused;
+            see the "reuse" option), and the number that attached to an
+            identical queue already running, instead of being evaluated
+            again (coalesced).'''
+        with self.lock_:
+            return tuple(sorted(self.counts_.items()))
+
+    def Error(self, code=None, clear=False):
+        '''Returns the full description of an error.
+
+        Inputs:
+            code: the error code returned in place of a result, such as
+                "#PYTHON?E12", or just "E12" or 12. If None or omitted, a
+                table of the errors recorded is returned instead.
+        Keywords:
+            clear: if True, the table of errors is emptied.
+        Outputs:
+            The error message, including the traceback; or a table with
+            the code, number of occurrences and summary of each error, most
+            recent first.'''
+        if code is None:
+            output_value = errors.table.summary()
+        else:
+            output_value = errors.table.lookup(code)
+            if output_value is None:
+                output_value = 'Error {} is no longer available'.format(code)
+        if clear:
+            errors.table.clear()
+        return output_value
 
     @staticmethod
     def range2var(rng):
         return rng.rsplit(']', 1)[-1].replace('!','_').replace(' ','').replace('$','').replace(':','_').replace('Sheet1_','')
 
-    def Call(self, queue):
+    def _invoke(self, step, args, kwargs, shape=None):
+        # If a shape is given, the function is told the shape of the
+        # caller's range; see axl.context.caller_shape().
+        obj = step.target
+        if step.kind == plans.LOCAL:
+            obj = getattr(self, step.name)
+        elif step.kind == plans.ATTR:
+            obj = args.pop(0)
+            for ftok in step.target:
+                obj = getattr(obj, ftok)
+        elif obj is None:
+            obj = step.lookup()
+        timeout = step.timeout
+        if timeout is None and (step.kind in (plans.IMPORT, plans.ATTR) or
+                                (step.kind == plans.METHOD and step.name in plans.BUDGETED)):
+            timeout = self.options_['timeout']
+        if shape is not None:
+            context.set_caller_shape(shape)
+        try:
+            if timeout:
+                output_value = workers.call_with_timeout(timeout, workers.call_limited, step.name, obj, args, kwargs)
+            else:
+                output_value = workers.call_limited(step.name, obj, args, kwargs)
+        finally:
+            if shape is not None:
+                context.set_caller_shape(None)
+        if iscoroutine(output_value):
+            return aio.submit(step.name, output_value, timeout)
+        return output_value
+
+    @staticmethod
+    def _await(values, refs):
+        # Wait for the coroutines whose results a command refers to; see
+        # axl.aio. Returns the error string if one of them failed.
+        for n in refs:
+            value = values[n]
+            if type(value) is aio.Pending:
+                try:
+                    values[n] = value.result()
+                except:
+                    return format_exception(value.name)
+
+    @staticmethod
+    def _settle(output_value):
+        # Wait for the coroutine, if any, whose result a queue returns.
+        if type(output_value) is not aio.Pending:
+            return output_value
+        try:
+            return output_value.result()
+        except:
+            return format_exception(output_value.name)
+
+    @staticmethod
+    def _bind(step, cmd, values):
+        cmd_args = cmd[1:]
+        args = [values[n] if ref else from_excel(cmd_args[n]) for ref, n in step.args]
+        kwargs = {key: values[n] if ref else from_excel(cmd_args[n]) for key, ref, n in step.kwargs}
+        return args, kwargs
+
+    def _tokens(self, plan, queue, shape):
+        # Identify each command for sharing within the current burst; see
+        # axl.memo.Burst. Commands are identified by name and the
+        # fingerprints of their argument values, which tell True, 1 and 1.0
+        # apart, with references replaced by the tokens of the commands
+        # they refer to, and Loads by address and version. A token of None
+        # marks a command whose result cannot be shared. The command told
+        # the caller's shape is identified by that shape, too.
+        tokens = []
+        for ndx, (step, cmd) in enumerate(zip(plan.steps, queue)):
+            key = None
+            if step.kind == plans.LOCAL:
+                if step.name == 'Load' and step.args[:1] == ((False, 0),):
+                    key = ('%Load', cmd[1], self.versions_.get(cmd[1]))
+            elif not (step.kind == plans.ATTR or step.volatile or step.error is not None or
+                      any(tokens[n] is None for n in step.refs)):
+                cmd_args = cmd[1:]
+                try:
+                    key = (cmd[0],
+                           tuple((ref, tokens[n] if ref else memo.fingerprint(cmd_args[n])) for ref, n in step.args),
+                           tuple((kw, ref, tokens[n] if ref else memo.fingerprint(cmd_args[n]))
+                                 for kw, ref, n in step.kwargs))
+                except TypeError:
+                    key = None
+                if key is not None and ndx == plan.shaped:
+                    key += (shape,)
+            tokens.append(None if key is None else self.burst_.token(key))
+        return tokens
+
+    def _execute(self, step, cmd, values, token=None, shape=None):
+        # Runs a single step without logging, returning an error string in
+        # place of raising an exception. If a token is supplied, the result
+        # is shared with other commands with the same token.
+        if token is not None:
+            output_value = self.burst_.get(token, _missing)
+            if output_value is not _missing:
+                return False, output_value
+        error = self._await(values, step.refs)
+        if error is not None:
+            return True, error
+        args, kwargs = self._bind(step, cmd, values)
+        try:
+            output_value = self._invoke(step, args, kwargs, shape)
+        except:
+            return True, format_exception(step.name)
+        if token is not None:
+            self.burst_.put(token, output_value)
+        return False, output_value
+
+    def _call_parallel(self, plan, queue, tokens, shape):
+        # Run the plan one wave at a time. Within each wave, the offloaded
+        # steps run on worker threads while the rest run on this one.
+        values = [None] * len(plan.steps)
+        shapes = [None] * len(plan.steps)
+        if shape is not None:
+            shapes[plan.shaped] = shape
+        executor = workers.pool('steps')
+        for inline, offload in plan.waves:
+            futures = [(ndx, executor.submit(self._execute, plan.steps[ndx], queue[ndx], values, tokens[ndx],
+                                             shapes[ndx]))
+                       for ndx in offload]
+            results = [(ndx, self._execute(plan.steps[ndx], queue[ndx], values, tokens[ndx], shapes[ndx]))
+                       for ndx in inline]
+            results.extend((ndx, future.result()) for ndx, future in futures)
+            failed = [(ndx, value) for ndx, (error, value) in results if error]
+            if failed:
+                return min(failed)[1]
+            for ndx, (error, value) in results:
+                values[ndx] = value
+        return values[-1]
+
+    def _reuse(self, plan, queue):
+        # Return the result of the last evaluation for this caller if it
+        # sent an identical queue, and the objects that queue loaded have
+        # not been saved again since. Queues are compared by fingerprint,
+        # which unlike the queues themselves tells True, 1 and 1.0 apart.
+        try:
+            key = memo.fingerprint(queue)
+        except TypeError:
+            return self._run(plan, queue)
+        caller = queue[-1]
+        stamps = tuple(map(self.versions_.get, plan.sources(queue)))
+        entry = self.results_.get(caller)
+        if entry is not None and entry[1] == stamps and entry[0] == key:
+            with self.lock_:
+                self.counts_['reused'] += 1
+            return entry[2]
+        output_value = self._run(plan, queue)
+        if type(output_value) is aio.Pending:
+            # The result of a coroutine is stored once it has succeeded,
+            # unless a later call for this caller has stored its own.
+            def store(future):
+                if not future.cancelled() and future.exception() is None and self.results_.get(caller) is entry:
+                    self.results_[caller] = (key, stamps, future.result())
+            output_value.future.add_done_callback(store)
+        elif not (type(output_value) is str and output_value.startswith(errors.PREFIX)):
+            self.results_[caller] = (key, stamps, output_value)
+        return output_value
+
+    def _coalesce(self, plan, queue):
+        # Attach to an identical queue that is already running, if there is
+        # one; otherwise, run this one, and let identical queues that arrive
+        # in the meantime attach to it. Queues are identical if they agree
+        # in everything but the caller, and load the same versions of the
+        # objects they load.
+        try:
+            key = memo.fingerprint((queue[:-1], tuple(map(self.versions_.get, plan.sources(queue)))))
+        except TypeError:
+            return self._dispatch(plan, queue)
+        with self.lock_:
+            future = self.inflight_.get(key)
+            leader = future is None
+            if leader:
+                future = self.inflight_[key] = Future()
+            else:
+                self.counts_['coalesced'] += 1
+        if not leader:
+            return future.result()
+        try:
+            output_value = self._dispatch(plan, queue)
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(output_value)
+        finally:
+            with self.lock_:
+                del self.inflight_[key]
+        return output_value
+
+    def _dispatch(self, plan, queue):
+        if queue[-1] and self.options_['reuse']:
+            return self._reuse(plan, queue)
+        return self._run(plan, queue)
+
+    def _call(self, queue):
+        plan = plans.compile_queue(queue)
+        counts = self.counts_
+        with self.lock_:
+            counts['calls'] += 1
+            counts['running'] += 1
+        try:
+            if not plan.reusable or self.dolog_:
+                return self._run(plan, queue)
+            # Every queue registers while it runs, since any queue may turn
+            # out to be the first of several identical ones.
+            if self.options_['coalesce']:
+                return self._coalesce(plan, queue)
+            return self._dispatch(plan, queue)
+        finally:
+            with self.lock_:
+                counts['running'] -= 1
+
+    def _run(self, plan, queue):
         # Process the calls in order, pushing the results onto a
         # result stack for potential later use. The top of the stack
-        # will be returned by the function.
+        # will be returned by the function. Parsing the queue and looking
+        # up its functions is done once per formula shape; see axl.plans.
+        dolog = self.dolog_
+        if plan.fused is not None and self.options_['fuse'] and not dolog:
+            output_value = fusion.run(plan.fused, plan.steps, queue)
+            if output_value is not fusion.DECLINED:
+                return output_value
+        shape = plan.shape(queue)
+        shaped = None if shape is None else plan.steps[plan.shaped]
+        if self.options_['share'] and not dolog:
+            self.burst_.touch()
+            tokens = self._tokens(plan, queue, shape)
+        else:
+            tokens = [None] * len(plan.steps)
+        if plan.parallel and self.options_['parallel'] and not dolog:
+            return self._call_parallel(plan, queue, tokens, shape)
         output_values = []
         output_range = queue[-1]
-        if self.dolog_:
+        pending = False
+        if dolog:
             output_reprs = []
             output_repr = ''
-        for ndx, cmd in enumerate(queue[:-1]):
-            cmd_name = cmd[0]
-            cmd_args = cmd[1:]
-            dolog = self.dolog_
-            args = []
-            kwargs = {}
-            key = None
-            if self.dolog_:
-                arg_reprs = []
-            for arg in map(from_excel, cmd_args):
-                if self.dolog_:
-                    arg_repr = repr(arg)
-                tstr = type(arg) is str
-                if tstr and arg[:2] == '!$':
-                    arg = int(arg[2:])
-                    if dolog:
-                        arg_repr = output_reprs[arg]
-                    arg = output_values[arg]
-                    tstr = False
-                if key is not None:
-                    if self.dolog_:
-                        arg_reprs.append('{}={}'.format(key, arg_repr))
-                    kwargs[key] = arg
-                    key = None
-                elif tstr and arg[-1:] == '=':
-                    key = arg[:-1]
-                elif kwargs:
-                    return '''#PYTHON?
-                        Error encountered parsing Python function "{}":
-                        Expected a keyword string, found this: {}'''.format(cmd_name, repr(arg))
+        for step, cmd, token in zip(plan.steps, queue, tokens):
+            if step.error is not None:
+                return step.parse_error(cmd, output_values)
+            if token is not None:
+                error, output_value = self._execute(step, cmd, output_values, token,
+                                                    shape if step is shaped else None)
+                if error:
+                    return output_value
+                if type(output_value) is aio.Pending:
+                    pending = True
+                output_values.append(output_value)
+                continue
+            if pending:
+                error = self._await(output_values, step.refs)
+                if error is not None:
+                    return error
+            args, kwargs = self._bind(step, cmd, output_values)
+            if dolog:
+                cmd_args = cmd[1:]
+                arg_reprs = [output_reprs[n] if ref else repr(arg) for (ref, n), arg in zip(step.args, args)]
+                arg_reprs.extend('{}={}'.format(key, output_reprs[n] if ref else repr(kwargs[key]))
+                                 for key, ref, n in step.kwargs)
+                if step.kind == plans.LOCAL:
+                    if step.name == 'Load':
+                        output_repr = self.range2var(args[0])
+                    elif step.name == 'Save' and not (type(cmd_args[1]) is str and cmd_args[1].startswith('!$')):
+                        output_repr = arg_reprs[1]
+                elif step.kind == plans.METHOD:
+                    output_repr = 'axlm.{}({})'.format(step.name, ', '.join(arg_reprs))
+                elif step.kind == plans.ATTR:
+                    output_repr = '{}.{}({})'.format(arg_reprs[0], step.name, ', '.join(arg_reprs[1:]))
                 else:
-                    args.append(arg)
-                    if dolog:
-                        arg_reprs.append(arg_repr)
-            if key is not None:
-                return '''#PYTHON?
-                    Error encountered parsing Python function "{}":
-                    Missing argument value for keyword "{}"'''.format(cmd_name, key)
+                    output_repr = '{}({})'.format(step.name, ', '.join(arg_reprs))
             try:
-                if cmd_name.startswith('%'):
-                    cmd_name = cmd_name[1:]
-                    obj = getattr(self, cmd_name)
-                    if self.dolog_:
-                        if cmd_name == 'Load':
-                            output_repr = self.range2var(args[0])
-                        elif cmd_name == 'Save' and not (type(cmd_args[1]) is str and cmd_args[1].startswith('!$')):
-                            output_repr = arg_reprs[1]
-                elif cmd_name.startswith('@'):
-                    cmd_name = cmd_name[1:]
-                    obj = getattr(methods, cmd_name)
-                    if self.dolog_:
-                        output_repr = 'axlm.{}({})'.format(cmd_name, ', '.join(arg_reprs))
-                else:
-                    cmd_parts = cmd_name.split('.')
-                    if cmd_parts[0] == '':
-                        obj = args[0]
-                        cmd_name = cmd_name[1:]
-                        if self.dolog_:
-                            output_repr = '{}.{}({})'.format(arg_reprs[0], cmd_name, ', '.join(arg_reprs[1:]))
-                    else:
-                        obj = _imports if hasattr(_imports, cmd_parts[0]) else __builtins__
-                        if self.dolog_:
-                            output_repr = '{}({})'.format(cmd_name, ', '.join(arg_reprs))
-                    for ftok in cmd_parts:
-                        obj = getattr(obj, ftok)
-                output_value = obj(*args, **kwargs)
+                output_value = self._invoke(step, args, kwargs, shape if step is shaped else None)
             except:
-                estr = exc_info()
-                tt = "   ".join(format_tb(estr[2]))
-                return '''#PYTHON?
-                    Error encountered executing Python function {}:
-                        {}: {}
-                        {}'''.format(cmd_name, estr[0].__name__, str(estr[1]), tt)
+                return format_exception(step.name)
+            if type(output_value) is aio.Pending:
+                pending = True
             output_values.append(output_value)
             if dolog:
                 output_reprs.append(output_repr)
 
-        # Wrap in an extra tuple so the calling function does not
-        # attempt to unpack it.
         if dolog and output_repr:
             final_name = self.range2var(output_range) if output_range else '_Out'
             final_line = '{} = {}'.format(final_name, output_repr)
-            self.log_.append(final_line)
+            with self.session_lock_:
+                self.log_.append(final_line)
+        return output_value
+
+    def _isolated(self, queue):
+        # The result may still be pending; see _settle().
+        try:
+            return self._call(queue)
+        except:
+            return format_exception('Call')
+
+    def _settled(self, queue):
+        return self._settle(self._isolated(queue))
+
+    def _submit(self, queue, lane):
+        # Run the queue in the background if permitted; otherwise, run it
+        # now. In either case, return the value Call() would return. A
+        # caller that sends the same queue again, loading the same versions
+        # of the same objects, gets the result of the call it started,
+        # or the same marker while that is still running.
+        plan = plans.compile_queue(queue)
+        if not plan.background:
+            return self._settled(queue)
+        caller = queue[-1]
+        try:
+            key = memo.fingerprint((queue, tuple(map(self.versions_.get, plan.sources(queue)))))
+        except TypeError:
+            key = None
+        with self.session_lock_:
+            self._expire()
+            prior = self.callers_.get(caller) if caller else None
+            if prior is not None and key is not None and prior[0] == key:
+                ticket = prior[1]
+                future = self.pending_[ticket][0]
+                if not future.done():
+                    return PENDING + str(ticket)
+                self._forget(ticket)
+                return future.result()
+            future = workers.submit(lane, [step.name for step in plan.steps], self._settled, queue)
+            ticket = next(self.tickets_)
+            self.pending_[ticket] = (future, caller)
+            if caller:
+                self.callers_[caller] = (key, ticket)
+        future.add_done_callback(lambda future: self.finished_.append((monotonic(), ticket)))
+        return PENDING + str(ticket)
+
+    def _expire(self):
+        # Discard the results of background calls that finished more than
+        # TICKET_SECONDS ago without being retrieved. Called with the
+        # session lock held.
+        finished = self.finished_
+        stale = monotonic() - TICKET_SECONDS
+        while finished and finished[0][0] < stale:
+            self._forget(finished.popleft()[1])
+
+    def _forget(self, ticket):
+        # Discard a ticket, once its result has been retrieved or has
+        # expired. Called with the session lock held.
+        entry = self.pending_.pop(ticket, None)
+        if entry is not None:
+            prior = self.callers_.get(entry[1])
+            if prior is not None and prior[1] == ticket:
+                del self.callers_[entry[1]]
+
+    def _lane(self):
+        # A call that starts a burst (see axl.memo.Burst) is taken for an
+        # edit of a single cell, and runs on the interactive lane; the
+        # calls that follow it closely are a recalculation, and run on the
+        # batch lane, so they never hold up the next edit.
+        now = monotonic()
+        with self.session_lock_:
+            interactive = now - self.called_ > memo.BURST_GAP
+            self.called_ = now
+        return 'interactive' if interactive else 'batch'
+
+    def Call(self, queue):
+        '''Evaluates the queue of commands built by a single Excel formula.
+
+        Inputs:
+            queue: a sequence of commands, each a command name followed by
+                its arguments, terminated by the address of the caller.
+        Outputs:
+            The result of the last command, or an error string. In
+            background mode, a pending marker is returned instead; see
+            Options() and Collect().'''
+        if self.options_['background']:
+            output_value = self._submit(queue, self._lane())
+        else:
+            output_value = self._settle(self._call(queue))
+        # Wrap in an extra tuple so the calling function does not
+        # attempt to unpack it.
+        return (output_value,) if type(output_value) is tuple else output_value
+
+    def CallMany(self, queues):
+        '''Evaluates a batch of queues in a single pass, amortizing the cost
+        of a round trip over many cells.
+
+        Inputs:
+            queues: a sequence of queues, each in the form accepted by Call(),
+                and each terminated by the address of its own caller.
+        Outputs:
+            A list containing the result of each queue, in order. A failing
+            queue yields its error string without affecting the others. In
+            background mode, the list contains pending markers instead.
+            Coroutines started by different queues run concurrently; see
+            axl.aio.'''
+        if self.options_['background']:
+            return [self._submit(queue, 'batch') for queue in queues]
+        return list(map(self._settle, list(map(self._isolated, queues))))
+
+    def Poll(self):
+        '''Returns the results of all background calls that have finished,
+        and have not yet been retrieved.
+
+        Outputs:
+            A list of (ticket, result) pairs, where ticket is the number
+            that followed the pending marker returned by Call().'''
+        with self.session_lock_:
+            self._expire()
+            done = [(ticket, future) for ticket, (future, caller) in list(self.pending_.items()) if future.done()]
+            for ticket, future in done:
+                self._forget(ticket)
+        return [(ticket, future.result()) for ticket, future in done]
+
+    def Collect(self, ticket, timeout=0):
+        '''Returns the result of a single background call.
+
+        Inputs:
+            ticket: the pending marker returned by Call(), or just the
+                ticket number that follows it.
+            timeout: the number of seconds to wait for the call to finish.
+        Outputs:
+            The result of the call. If it is still running, the pending
+            marker is returned again.'''
+        if type(ticket) is str and ticket.startswith(PENDING):
+            ticket = ticket[len(PENDING):]
+        ticket = int(ticket)
+        with self.session_lock_:
+            self._expire()
+            entry = self.pending_.get(ticket)
+        if entry is None:
+            return '#PYTHON?\n    No background call has ticket {}'.format(ticket)
+        try:
+            output_value = entry[0].result(timeout)
+        except TimeoutError:
+            return PENDING + str(ticket)
+        with self.session_lock_:
+            self._forget(ticket)
         return (output_value,) if type(output_value) is tuple else output_value
 
 
 def execute(clsid):
+    # The COM machinery is imported here, rather than at the top of the
+    # module, so the command loop itself can be driven without pywin32.
+    from pywintypes import IID
+    import win32com.client
+    import win32com.server.util
+    import win32com.server.dispatcher
+    import win32com.server.policy
+    import win32api
+    import pythoncom
+
     clsid = IID(clsid)
     BaseDefaultPolicy = win32com.server.policy.DefaultPolicy
 
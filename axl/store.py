@@ -0,0 +1,481 @@
+'''Storage for the objects saved by Excel cells.
+
+Objects are saved under the external address of a cell, such as
+"[Book1.xlsx]Sheet1!$A$1", and are grouped into sessions, one per
+workbook, named after the part of the address in brackets. The memory
+used by each session is accounted for, and limited by a quota, and a
+session may be dropped as a whole once its workbook is closed.
+
+Objects outlive the cells that saved them, once those are cleared or
+moved, and many more are saved than are loaded at any one time. The
+store is therefore divided into three tiers, each with a size limit:
+
+    hot: objects kept in memory as they are.
+    warm: objects pickled and compressed, still in memory.
+    cold: objects spilled to files on local disk. NumPy arrays are saved
+        in .npy format, and memory-mapped when loaded, so only the parts
+        that are used are read; other objects are compressed pickles.
+
+When a tier exceeds its limit, its least recently used objects are moved
+to the next one, except that an object used more than once since it last
+moved is given another chance; objects that overflow the cold tier, or
+cannot be pickled, are evicted. Objects in the lower tiers are returned
+to the hot tier once they are loaded PROMOTE_USES times, if they fit
+there. Loading an evicted object raises an error asking for the cell
+that saved it to be recalculated.'''
+
+import os
+import atexit
+import shutil
+import pickle
+import tempfile
+import threading
+import zlib
+from itertools import count
+from collections import OrderedDict
+
+import numpy as np
+
+from .memo import sizeof
+
+SESSION_QUOTA = 2 * 1024 * 1024 * 1024
+MAX_BYTES = 4 * 1024 * 1024 * 1024
+WARM_BYTES = 1024 * 1024 * 1024
+COLD_BYTES = 64 * 1024 * 1024 * 1024
+PROMOTE_USES = 2
+# An object is compressed into the warm tier only if that makes it at
+# least this much smaller; otherwise, it goes straight to disk.
+WARM_RATIO = 0.75
+# The directory for the cold tier. If None, a temporary directory is
+# created on first use, and removed when the server exits.
+DIRECTORY = None
+# The number of evicted addresses remembered, so that loading them
+# reports the eviction rather than returning None.
+MAX_EVICTED = 65536
+
+HOT, WARM, COLD = range(3)
+TIERS = ('hot', 'warm', 'cold')
+
+
+class QuotaExceeded(MemoryError):
+    '''Raised when saving an object would exceed the quota of its session,
+    or when an object is larger than the hot tier and cannot be moved to
+    the others.'''
+
+
+class Evicted(KeyError):
+    '''Raised when loading an object that was evicted to respect the limits
+    of the store.'''
+
+
+def session_of(addr):
+    '''Returns the session name for an external cell address: the name of
+    the workbook, or the empty string if the address has none.'''
+    start = addr.find('[')
+    end = addr.find(']', start + 1)
+    return addr[start + 1:end] if start >= 0 and end > start else ''
+
+
+def part_address(addr, part):
+    '''Returns the address under which a component of the object saved at
+    addr is saved; see component(). Excel passes numbers as floats, so
+    integral parts are written without a decimal point.'''
+    if type(part) is float and part.is_integer():
+        part = int(part)
+    return '{}|{}'.format(addr, part)
+
+
+def component(obj, part):
+    '''Returns a component of an object: the value of a dictionary key, the
+    element of a sequence at an (integral) index, or else an attribute.'''
+    if isinstance(obj, dict):
+        return obj[part]
+    if isinstance(obj, (tuple, list)) and isinstance(part, (int, float)):
+        return obj[int(part)]
+    return getattr(obj, part)
+
+
+class Session(object):
+    '''The objects saved by a single workbook.
+
+    Attributes:
+        objects: a dictionary mapping addresses to Entries.
+        nbytes: the total estimated size of the objects, in memory.
+        quota: the maximum total size, or None for no limit.'''
+    __slots__ = ('objects', 'nbytes', 'quota')
+
+    def __init__(self, quota):
+        self.objects = {}
+        self.nbytes = 0
+        self.quota = quota
+
+
+class Entry(object):
+    '''A saved object.
+
+    Attributes:
+        name: the name of its session.
+        size: the estimated size of the object, in memory.
+        tier: HOT, WARM or COLD.
+        value: the object, if hot; its compressed pickle, if warm; or the
+            path of its file, if cold.
+        nbytes: the size charged to its tier: size, if hot; otherwise, the
+            size of the compressed pickle or file.
+        array: True if the object is a NumPy array of a non-object dtype,
+            saved in .npy format when cold.
+        uses: the number of loads since the object last moved, less those
+            forgiven by the second chances it was given.'''
+    __slots__ = ('name', 'size', 'tier', 'value', 'nbytes', 'array', 'uses')
+
+    def __init__(self, name, obj, size):
+        self.name = name
+        self.size = size
+        self.tier = HOT
+        self.value = obj
+        self.nbytes = size
+        self.array = type(obj) is np.ndarray and obj.size > 0 and not obj.dtype.hasobject
+        self.uses = 0
+
+
+def _freeze(obj):
+    # Returns the compressed pickle of an object, or None if it cannot be
+    # pickled.
+    try:
+        return zlib.compress(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL), 1)
+    except Exception:
+        return None
+
+
+def _thaw(tier, value):
+    # Returns the object of a warm or cold entry.
+    if tier == COLD and value.endswith('.npy'):
+        return np.load(value, mmap_mode='c')
+    if tier == COLD:
+        with open(value, 'rb') as fp:
+            value = fp.read()
+    return pickle.loads(zlib.decompress(value))
+
+
+class SessionStore(object):
+    '''A thread-safe, tiered store of saved objects, partitioned into
+    sessions.
+
+    Attributes:
+        versions: a dictionary mapping each address to a number that
+            increases every time an object is saved there. It may be read
+            without locking, and serves to detect changed inputs.
+        quota: the quota given to new sessions, in bytes, or None.
+        limits: the size limits of the hot, warm and cold tiers, in bytes;
+            None for no limit, 0 to disable a tier.
+        directory: the directory of the cold tier, or None.
+        counts: a dictionary of counters of store activity: hits and
+            misses; warm_hits and cold_hits, the hits served from those
+            tiers; promotions, demotions and evictions; and evicted_bytes.
+            A load of an evicted object counts as a miss.'''
+
+    def __init__(self, quota=SESSION_QUOTA, max_bytes=MAX_BYTES, warm_bytes=WARM_BYTES,
+                 cold_bytes=COLD_BYTES, directory=DIRECTORY):
+        self.sessions = {}
+        self.versions = {}
+        self.quota = quota
+        self.limits = [max_bytes, warm_bytes, cold_bytes]
+        self.directory = directory
+        # The addresses in each tier, least recently used first, with the
+        # total size charged to each, and the addresses of recently
+        # evicted objects.
+        self.tiers = (OrderedDict(), OrderedDict(), OrderedDict())
+        self.nbytes = [0, 0, 0]
+        self.evicted = OrderedDict()
+        self.counts = dict.fromkeys(('hits', 'misses', 'warm_hits', 'cold_hits', 'promotions', 'demotions',
+                                     'evictions', 'evicted_bytes'), 0)
+        # Files that could not be removed yet, because an array loaded
+        # from them is still mapped.
+        self.doomed = []
+        self.stamps = count(1)
+        self.files = count(1)
+        self.lock = threading.Lock()
+        # Serializes the moves between tiers, which are done outside the
+        # main lock so that loads are not held up by them.
+        self.move_lock = threading.Lock()
+
+    def save(self, addr, obj):
+        '''Saves an object under an address, replacing any previous one.
+
+        Raises:
+            QuotaExceeded, if the object would take its session over quota,
+            or is larger than the hot tier while the others are disabled.
+            The previous object is removed nonetheless, so that it is not
+            mistaken for the result of the failed save.'''
+        name = session_of(addr)
+        size = sizeof(obj)
+        with self.lock:
+            session = self.sessions.get(name)
+            if session is None:
+                session = self.sessions[name] = Session(self.quota)
+            path = self._remove(session, addr)
+            self.evicted.pop(addr, None)
+            if session.quota is not None and session.nbytes + size > session.quota:
+                self.versions.pop(addr, None)
+                raise QuotaExceeded('Saving {} ({} bytes) would exceed the quota of session "{}": '
+                                    '{} of {} bytes in use'.format(addr, size, name, session.nbytes, session.quota))
+            max_bytes = self.limits[HOT]
+            if max_bytes is not None and size > max_bytes and not any(self.limits[WARM:]):
+                self.versions.pop(addr, None)
+                raise QuotaExceeded('Saving {} ({} bytes) would exceed the limit of {} bytes '
+                                    'on all saved objects'.format(addr, size, max_bytes))
+            session.objects[addr] = entry = Entry(name, obj, size)
+            session.nbytes += size
+            self._place(addr, entry, HOT, obj, size)
+            self.versions[addr] = next(self.stamps)
+        self._unlink(path)
+        self._rebalance()
+
+    def load(self, addr):
+        '''Returns the object saved under an address, or None.
+
+        Raises:
+            Evicted, if the object was evicted to respect the limits.'''
+        while True:
+            with self.lock:
+                session = self.sessions.get(session_of(addr))
+                entry = None if session is None else session.objects.get(addr)
+                if entry is None:
+                    self.counts['misses'] += 1
+                    if addr in self.evicted:
+                        raise Evicted('The object saved at {} was evicted to respect the limits of the store; '
+                                      'recalculate the cell that saves it'.format(addr))
+                    return None
+                self.counts['hits'] += 1
+                self.tiers[entry.tier].move_to_end(addr)
+                entry.uses += 1
+                tier, value = entry.tier, entry.value
+                if tier == HOT:
+                    return value
+                self.counts[TIERS[tier] + '_hits'] += 1
+            try:
+                obj = _thaw(tier, value)
+                break
+            except OSError:
+                # The file is gone if the object has moved or been
+                # replaced meanwhile; if not, the error is genuine.
+                with self.lock:
+                    if session.objects.get(addr) is entry and entry.tier == tier:
+                        raise
+        if entry.uses >= PROMOTE_USES:
+            obj = self._promote(addr, entry, tier, obj)
+        return obj
+
+    def _place(self, addr, entry, tier, value, nbytes):
+        # Puts an entry in a tier, as its most recently used address.
+        entry.tier, entry.value, entry.nbytes = tier, value, nbytes
+        self.tiers[tier][addr] = entry
+        self.nbytes[tier] += nbytes
+
+    def _take(self, addr, entry):
+        # Takes an entry out of its tier, returning the path of its file,
+        # if it has one, to be removed once the lock is released.
+        del self.tiers[entry.tier][addr]
+        self.nbytes[entry.tier] -= entry.nbytes
+        return entry.value if entry.tier == COLD else None
+
+    def _remove(self, session, addr):
+        # Removes an object, if present; see _take().
+        entry = session.objects.pop(addr, None)
+        if entry is None:
+            return None
+        session.nbytes -= entry.size
+        return self._take(addr, entry)
+
+    def _evict(self, addr, entry):
+        # Removes an object to make room, remembering that it was evicted.
+        path = self._remove(self.sessions[entry.name], addr)
+        self.versions.pop(addr, None)
+        self.counts['evictions'] += 1
+        self.counts['evicted_bytes'] += entry.size
+        self.evicted[addr] = None
+        if len(self.evicted) > MAX_EVICTED:
+            self.evicted.popitem(last=False)
+        return path
+
+    def _promote(self, addr, entry, tier, obj):
+        # Returns an object loaded from a lower tier to the hot tier, unless
+        # it has moved or been replaced meanwhile, or is larger than the
+        # hot tier, which it would leave again at once. A memory-mapped
+        # array is read into memory first.
+        limit = self.limits[HOT]
+        if limit is not None and entry.size > limit:
+            return obj
+        if isinstance(obj, np.memmap):
+            obj = np.array(obj)
+        with self.lock:
+            session = self.sessions.get(entry.name)
+            if session is None or session.objects.get(addr) is not entry or entry.tier != tier:
+                return obj
+            path = self._take(addr, entry)
+            self._place(addr, entry, HOT, obj, entry.size)
+            entry.uses = 0
+            self.counts['promotions'] += 1
+        self._unlink(path)
+        self._rebalance()
+        return obj
+
+    def _victim(self, tier):
+        # Returns the least recently used entry of a tier over its limit,
+        # giving another chance to those used more than once; or None.
+        entries = self.tiers[tier]
+        limit = self.limits[tier]
+        while entries and limit is not None and self.nbytes[tier] > limit:
+            addr, entry = next(iter(entries.items()))
+            if entry.uses < 2:
+                return addr, entry, entry.uses
+            entry.uses //= 2
+            entries.move_to_end(addr)
+        return None
+
+    def _spill(self, entry, obj, frozen):
+        # Writes an object to a new file of the cold tier, returning the
+        # path and size of the file, or None if it cannot be written. An
+        # object that is not an array is written as its compressed pickle.
+        try:
+            if self.directory is None:
+                self.directory = tempfile.mkdtemp(prefix='axl-store-')
+                atexit.register(shutil.rmtree, self.directory, True)
+            path = os.path.join(self.directory, str(next(self.files)))
+            if entry.array:
+                path += '.npy'
+                np.save(path, _thaw(WARM, frozen) if obj is None else obj)
+            else:
+                path += '.pkl'
+                with open(path, 'wb') as fp:
+                    fp.write(frozen)
+            return path, os.path.getsize(path)
+        except Exception:
+            return None
+
+    def _move(self, tier, addr, entry, uses):
+        # Moves an entry down from the hot or warm tier, or evicts it if it
+        # cannot be moved. The object is compressed or written without
+        # holding the lock; it is then put in place, unless it was loaded,
+        # moved or replaced meanwhile.
+        obj = frozen = target = None
+        if tier == HOT:
+            obj = entry.value
+            if not entry.array or self.limits[WARM] != 0:
+                frozen = _freeze(obj)
+            if frozen is not None and self.limits[WARM] != 0 and len(frozen) <= WARM_RATIO * entry.size:
+                target = WARM, frozen, len(frozen)
+        else:
+            frozen = entry.value
+        if target is None and self.limits[COLD] != 0 and (entry.array or frozen is not None):
+            spilled = self._spill(entry, obj, frozen)
+            if spilled is not None:
+                target = (COLD,) + spilled
+        path = None
+        with self.lock:
+            session = self.sessions.get(entry.name)
+            if (session is not None and session.objects.get(addr) is entry and
+                    entry.tier == tier and entry.uses == uses):
+                if target is None:
+                    path = self._evict(addr, entry)
+                else:
+                    path = self._take(addr, entry)
+                    self._place(addr, entry, *target)
+                    self.counts['demotions'] += 1
+                    target = None
+        self._unlink(path)
+        # A file written in vain is removed.
+        if target is not None and target[0] == COLD:
+            self._unlink(target[1])
+
+    def _rebalance(self):
+        # Moves objects down the tiers until each is within its limit.
+        if all(limit is None or nbytes <= limit for limit, nbytes in zip(self.limits, self.nbytes)):
+            return
+        with self.move_lock:
+            while True:
+                with self.lock:
+                    for tier in (HOT, WARM, COLD):
+                        victim = self._victim(tier)
+                        if victim is not None:
+                            break
+                    if victim is None:
+                        break
+                    addr, entry, uses = victim
+                    if tier == COLD:
+                        path = self._evict(addr, entry)
+                if tier == COLD:
+                    self._unlink(path)
+                else:
+                    self._move(tier, addr, entry, uses)
+        with self.lock:
+            doomed, self.doomed = self.doomed, []
+        for path in doomed:
+            self._unlink(path)
+
+    def _unlink(self, path):
+        if path is not None:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                self.doomed.append(path)
+
+    def drop(self, name):
+        '''Removes a session and all of its objects.
+
+        Outputs:
+            The number of objects removed, and their total size.'''
+        with self.lock:
+            session = self.sessions.pop(name, None)
+            if session is None:
+                return 0, 0
+            paths = []
+            for addr, entry in session.objects.items():
+                self.versions.pop(addr, None)
+                paths.append(self._take(addr, entry))
+            for addr in [addr for addr in self.evicted if session_of(addr) == name]:
+                del self.evicted[addr]
+        for path in paths:
+            self._unlink(path)
+        return len(session.objects), session.nbytes
+
+    def set_quota(self, quota, name=None):
+        '''Changes the quota of a session or, if no name is given, that of
+        all sessions, present and future. Objects already saved are kept
+        even if they exceed the new quota.'''
+        with self.lock:
+            if name is None:
+                self.quota = quota
+                for session in self.sessions.values():
+                    session.quota = quota
+            else:
+                session = self.sessions.get(name)
+                if session is None:
+                    session = self.sessions[name] = Session(quota)
+                session.quota = quota
+
+    def resize(self, limit, tier=HOT):
+        '''Changes the size limit of a tier, moving objects as needed; None
+        removes the limit, and 0 disables the tier.'''
+        with self.lock:
+            self.limits[tier] = limit
+        self._rebalance()
+
+    def stats(self):
+        '''Returns the name, object count, size and quota of each session,
+        as a table.'''
+        with self.lock:
+            return tuple((name, len(session.objects), session.nbytes, session.quota)
+                         for name, session in sorted(self.sessions.items()))
+
+    def totals(self):
+        '''Returns the statistics of the store as a whole, as a two-column
+        table: the number of objects, total size and limit of each tier,
+        followed by the counters of store activity.'''
+        with self.lock:
+            table = []
+            for tier, label in enumerate(TIERS):
+                table.extend(((label + '_entries', len(self.tiers[tier])), (label + '_bytes', self.nbytes[tier]),
+                              (label + '_limit', self.limits[tier])))
+            return tuple(table) + tuple(sorted(self.counts.items()))
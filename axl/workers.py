@@ -0,0 +1,256 @@
+'''Worker pools for running command queues off the COM server thread.
+
+Work is submitted to one of several lanes, each served by its own
+bounded pool of threads. Interactive work (a single cell, typically
+just edited by the user) has a lane of its own, so it never waits
+behind a large batch recalculation. The independent commands within
+a single queue are run on a separate lane of their own, so a queue that
+is itself running on a worker never waits for a thread of its own lane.
+Work that calls a function with a concurrency limit waits for its turn
+before it is given a thread, so that it never holds up other work.
+
+Functions marked with the "process" option in the imports files are
+instead run in a persistent pool of worker processes, so that CPU-bound
+Python code is not confined to a single core by the GIL.
+
+Calls with a time budget run on a thread of their own, which is simply
+abandoned (after asking it to stop; see axl.context) if it overruns. A
+call with a budget that is sent to a worker process runs on a process of
+its own, drawn from a set of spares, which is terminated if it overruns;
+the calls running in the shared process pool are not disturbed.'''
+
+import os
+import asyncio
+import threading
+from functools import partial
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from . import context
+
+LANES = {'interactive': 2, 'batch': 8, 'steps': 8}
+
+_lock = threading.Lock()
+_pools = {}
+_limits = {}
+_counts = {}
+_admit_lock = threading.Lock()
+_admitted = {}
+_waiting = deque()
+_processes = None
+_spares = []
+
+
+def pool(lane):
+    '''Returns the thread pool serving the given lane, creating it on
+    first use.'''
+    executor = _pools.get(lane)
+    if executor is None:
+        with _lock:
+            executor = _pools.get(lane)
+            if executor is None:
+                executor = _pools[lane] = ThreadPoolExecutor(LANES[lane])
+    return executor
+
+
+def set_limit(name, count):
+    '''Limits the number of concurrent calls to a function.
+
+    Inputs:
+        name: the function name, as it appears in the command queue.
+        count: the maximum number of simultaneous calls. If None, any
+            existing limit is removed.'''
+    with _admit_lock:
+        if count is None:
+            _limits.pop(name, None)
+            _counts.pop(name, None)
+        else:
+            _limits[name] = threading.BoundedSemaphore(int(count))
+            _counts[name] = int(count)
+        _admit()
+
+
+def call_limited(name, func, args, kwargs):
+    '''Calls a function, respecting any concurrency limit set for its name.'''
+    sem = _limits.get(name)
+    if sem is None:
+        return func(*args, **kwargs)
+    with sem:
+        return func(*args, **kwargs)
+
+
+def submit(lane, names, func, *args):
+    '''Submits func(*args) to the pool of threads serving a lane. If any of
+    the named functions has a concurrency limit (see set_limit()), the work
+    waits, without taking a thread, until fewer than that many pieces of
+    work submitted for the function are running.
+
+    Inputs:
+        lane: the lane; see pool().
+        names: the names of the functions the work calls.
+        func, *args: the function to call, and its arguments.
+    Outputs:
+        A concurrent.futures.Future for the result.'''
+    future = Future()
+    with _admit_lock:
+        _waiting.append((lane, frozenset(names), future, func, args))
+        _admit()
+    return future
+
+
+def _admit():
+    # Starts the waiting work that the limits now allow, in order. Called
+    # with _admit_lock held.
+    for entry in list(_waiting):
+        limited = [name for name in entry[1] if name in _counts]
+        if all(_admitted.get(name, 0) < _counts[name] for name in limited):
+            _waiting.remove(entry)
+            for name in limited:
+                _admitted[name] = _admitted.get(name, 0) + 1
+            pool(entry[0]).submit(_run, entry, limited)
+
+
+def _run(entry, limited):
+    lane, names, future, func, args = entry
+    try:
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(func(*args))
+            except BaseException as exc:
+                future.set_exception(exc)
+    finally:
+        with _admit_lock:
+            for name in limited:
+                _admitted[name] -= 1
+            _admit()
+
+
+class Timeout(Exception):
+    '''Raised when a call exceeds its time budget.'''
+
+
+def call_with_timeout(timeout, func, *args):
+    '''Calls func(*args) on a new thread, and waits for the result.
+
+    Inputs:
+        timeout: the time budget for the call, in seconds.
+        func, *args: the function to call, and its arguments.
+    Outputs:
+        The return value of the function. If the function raises an
+        exception, so does this.
+    Raises:
+        Timeout, if the call overruns its budget. The thread is then asked
+        to stop, through its axl.context, and abandoned.'''
+    ctx = context.CallContext(timeout)
+    shape = context.caller_shape()
+    outcome = []
+
+    def target():
+        context.activate(ctx)
+        context.set_caller_shape(shape)
+        try:
+            outcome.append((True, func(*args)))
+        except BaseException as exc:
+            outcome.append((False, exc))
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if not outcome:
+        ctx.cancel()
+        raise Timeout('Exceeded the time budget of {} seconds'.format(timeout))
+    success, value = outcome[0]
+    if success:
+        return value
+    raise value
+
+
+def _preload():
+    # Importing axl.imports parses the imports files, so every worker
+    # starts with the same namespace as the server.
+    from . import imports  # noqa: F401
+
+
+def _call_symbol(name, args, kwargs):
+    from .imports import resolve
+    output_value = resolve(name)(*args, **kwargs)
+    if asyncio.iscoroutine(output_value):
+        output_value = asyncio.run(output_value)
+    return output_value
+
+
+def process_pool():
+    '''Returns the pool of worker processes, starting it on first use.
+    There is one worker per CPU, and the workers persist until the server
+    exits, so the cost of starting them is paid only once.'''
+    global _processes
+    if _processes is None:
+        with _lock:
+            if _processes is None:
+                _processes = ProcessPoolExecutor(os.cpu_count(), initializer=_preload)
+    return _processes
+
+
+def _terminate(executor):
+    terminate = getattr(executor, 'terminate_workers', None)
+    if terminate is not None:
+        terminate()
+    else:
+        for proc in list((executor._processes or {}).values()):
+            proc.terminate()
+        executor.shutdown(wait=False)
+
+
+def _spare():
+    # Returns an idle single-process pool for a call that may have to be
+    # abandoned, starting one if there is none.
+    with _lock:
+        if _spares:
+            return _spares.pop()
+    return ProcessPoolExecutor(1, initializer=_preload)
+
+
+def call_in_process(name, *args, **kwargs):
+    '''Calls an imported function in a worker process and waits for the
+    result. The function is sent by name, and resolved by the worker in
+    its own copy of the imports namespace; only the arguments and the
+    result are pickled.
+
+    If the calling thread has a context (see axl.context), the call runs
+    on a spare process of its own, which is terminated if the context is
+    cancelled while the call is running. Otherwise, it runs in the shared
+    process pool.
+
+    Inputs:
+        name: the (possibly dotted) symbol name of the function.
+        *args, **kwargs: the arguments to pass to the function.
+    Outputs:
+        The return value of the function.'''
+    ctx = context.current()
+    if ctx is None:
+        return process_pool().submit(_call_symbol, name, args, kwargs).result()
+    executor = _spare()
+    future = executor.submit(_call_symbol, name, args, kwargs)
+    # The process is terminated only while it is still running this call;
+    # afterwards, it may be running another.
+    running = [executor]
+    ctx.on_cancel(partial(_abandon, running))
+    try:
+        return future.result()
+    finally:
+        with _lock:
+            keep = bool(running) and len(_spares) < (os.cpu_count() or 1)
+            del running[:]
+            if keep and future.done() and not isinstance(future.exception(), BrokenProcessPool):
+                _spares.append(executor)
+                executor = None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+def _abandon(running):
+    with _lock:
+        executor = running.pop() if running else None
+    if executor is not None:
+        _terminate(executor)
@@ -0,0 +1,57 @@
+'''Hammers a single command loop from many threads, with result reuse and
+burst sharing on, as a multi-threaded COM server would.'''
+
+import random
+import threading
+
+from axl.server import CommandLoop
+
+THREADS = 16
+ROUNDS = 300
+
+
+def test_many_threads():
+    loop = CommandLoop()
+    loop.Options(reuse=True, share=True)
+    failures = []
+
+    def work(thread):
+        rng = random.Random(thread)
+        try:
+            for n in range(ROUNDS):
+                # An address of its own, whose value this thread knows...
+                own = '[Book{}.xlsx]Sheet1!$A${}'.format(thread % 4, thread)
+                value = float(thread * ROUNDS + n)
+                loop.Save(own, value)
+                if loop.Load(own) != value:
+                    failures.append(('Load', thread, n))
+                queue = (('%Load', own), ('max', '!$ 0', 1.0), ('@ToExcel', '!$ 1', 1, 1),
+                         '[Book{}.xlsx]Sheet1!$B${}'.format(thread % 4, thread))
+                result = loop.Call(queue)
+                if result != max(value, 1.0):
+                    failures.append(('Call', thread, n, result))
+                # ...and addresses shared with the others, whose values
+                # are always one of a known few.
+                k = rng.randrange(8)
+                shared = '[Shared.xlsx]Sheet1!$A${}'.format(k)
+                loop.Save(shared, float(k))
+                queue = (('%Load', shared), ('max', '!$ 0', 3.0), ('@ToExcel', '!$ 1', 1, 1),
+                         '[Shared.xlsx]Sheet1!$B${}'.format(rng.randrange(4)))
+                result = loop.Call(queue)
+                if result != max(k, 3.0):
+                    failures.append(('Shared', thread, n, result))
+                results = loop.CallMany(((('abs', -value), 'C1'), (('min', value, 1.0), 'C2')))
+                if list(results) != [value, min(value, 1.0)]:
+                    failures.append(('CallMany', thread, n, results))
+        except Exception as exc:
+            failures.append(('raised', thread, repr(exc)))
+
+    threads = [threading.Thread(target=work, args=(thread,)) for thread in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert failures == []
+    stats = dict(loop.Stats())
+    assert stats['running'] == 0
+    assert stats['calls'] >= THREADS * ROUNDS * 4
@@ -0,0 +1,56 @@
+'''DFCols must return the same cells whether or not it is told the shape of
+the caller's range; see axl.context.caller_shape().'''
+
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from axl.server import CommandLoop
+
+nan = float('nan')
+ADDR = '[Test.xlsx]Sheet1!$A$1'
+
+
+def shown(loop, frame, options, nr, nc, headers):
+    # Returns the cells shown with and without the caller's shape. In the
+    # second queue, the DFCols result is also used by Grab, so it is not
+    # told the shape.
+    loop.Save(ADDR, frame)
+    tail = () if headers else (False,)
+    dfcols = ('@DFCols', '!$ 0') + options
+    shaped = (('%Load', ADDR), dfcols, ('@ToExcel', '!$ 1', nr, nc) + tail, 'B1')
+    unshaped = (('%Load', ADDR), dfcols, ('@Grab', '!$ 1'), ('@ToExcel', '!$ 2', nr, nc) + tail, 'B1')
+    return loop.Call(shaped), loop.Call(unshaped)
+
+
+@pytest.mark.parametrize('headers', [True, False])
+def test_missing_sort_keys(headers):
+    frame = pd.DataFrame({'a': [1, nan, 0, 1, 2, nan, 0], 'b': [1., 2., 3., 4., 5., 6., 7.]})
+    options = ('columns=', 'a', 'sortby=', ('a', 'b'), 'ascending=', (False, True))
+    first, second = shown(CommandLoop(), frame, options, 7, 1, headers)
+    assert repr(first) == repr(second)
+    assert not str(first).startswith('#PYTHON?')
+
+
+def test_random_frames():
+    rng = random.Random(0)
+    loop = CommandLoop()
+    for trial in range(200):
+        n = rng.choice([0, 1, 3, 20, 200])
+        frame = pd.DataFrame({'a': [rng.choice([1.0, 2.0, 3.0, nan]) for _ in range(n)],
+                              'b': [rng.randint(0, 5) for _ in range(n)],
+                              'c': [rng.choice('xyz') for _ in range(n)],
+                              'd': np.arange(n) * 0.5})
+        if rng.random() < 0.3:
+            frame = frame.set_index('c')
+        options = ()
+        if rng.random() < 0.5:
+            options += ('columns=', tuple((x,) for x in rng.sample('abcd', rng.randint(1, 4))))
+        if rng.random() < 0.8:
+            sortby = tuple(rng.sample('abcd', rng.randint(1, 2)))
+            options += ('sortby=', sortby, 'ascending=', tuple(rng.choice([True, False]) for _ in sortby))
+        nr, nc = rng.choice([1, 2, 5, 30]), rng.choice([1, 2, 5])
+        first, second = shown(loop, frame, options, nr, nc, rng.random() < 0.7)
+        assert repr(first) == repr(second), (options, nr, nc)
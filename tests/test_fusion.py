@@ -0,0 +1,49 @@
+'''A fused chain of commands must return exactly what the commands return
+when run one by one; see axl.fusion.'''
+
+import random
+
+from axl import fusion, plans
+from axl.server import CommandLoop
+
+
+def random_queue(rng):
+    kinds = [lambda: float(rng.randint(0, 5)), lambda: rng.choice(['a', 'b', 'c']),
+             lambda: rng.choice([True, False]), lambda: None, lambda: 3]
+    names = ['a', 'b', 'c', 'd', 'index'] if rng.random() < 0.1 else ['a', 'b', 'c', 'd']
+    headers = tuple(rng.sample(names, rng.randint(1, 4)))
+    columns = [rng.choice(kinds[:3]) if rng.random() < 0.8 else rng.choice(kinds) for _ in headers]
+    rows = tuple(tuple(kind() if rng.random() < 0.9 else rng.choice(kinds)() for kind in columns)
+                 for _ in range(rng.randint(0, 30)))
+    dfcols = ['@DFCols', '!$ 0']
+    if rng.random() < 0.6:
+        dfcols += ['columns=', (tuple(rng.sample(headers, rng.randint(1, len(headers)))),)]
+    if rng.random() < 0.2:
+        dfcols += ['exclude=', headers[0]]
+    if rng.random() < 0.6:
+        sortby = tuple(rng.sample(headers, rng.randint(1, min(2, len(headers)))))
+        dfcols += ['sortby=', (sortby,)]
+        if rng.random() < 0.7:
+            dfcols += ['ascending=', (tuple(rng.choice([True, False]) for _ in sortby),)]
+    toexcel = ['@ToExcel', '!$ 1', rng.choice([-1, 1, 2, 5, 40]), rng.choice([-1, 1, 3, 6])]
+    if rng.random() < 0.5:
+        toexcel.append(rng.choice([True, False]))
+    return (('@ColDF', (headers,) + rows), tuple(dfcols), tuple(toexcel), '[Test.xlsx]Sheet1!$A$1')
+
+
+def test_fused_matches_unfused():
+    rng = random.Random(1)
+    loop = CommandLoop()
+    fused = 0
+    for trial in range(400):
+        queue = random_queue(rng)
+        loop.Options(fuse=False)
+        expected = loop.Call(queue)
+        loop.Options(fuse=True)
+        plan = plans.compile_queue(queue)
+        assert plan.fused is not None
+        if fusion.run(plan.fused, plan.steps, queue) is not fusion.DECLINED:
+            fused += 1
+        assert repr(loop.Call(queue)) == repr(expected), queue
+    # Many queues, but not all, take the fused path
+    assert fused > 80
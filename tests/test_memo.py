@@ -0,0 +1,35 @@
+import time
+
+from axl import memo
+
+
+def test_fingerprint_distinguishes_types():
+    # True == 1 == 1.0, but a pure function may treat them differently
+    keys = [memo.fingerprint(x) for x in (((True,),), ((1.0,),), ((1,),), (True, 1.0), (1, True))]
+    assert len(set(keys)) == len(keys)
+    assert memo.fingerprint(((1.0, 'a'),)) == memo.fingerprint(((1.0, 'a'),))
+
+
+def test_pure_call_keys_on_types():
+    calls = []
+
+    def ident(x):
+        calls.append(x)
+        return repr(x)
+    assert memo.call(ident, ident, ((True,),)) == '((True,),)'
+    assert memo.call(ident, ident, ((1.0,),)) == '((1.0,),)'
+    assert memo.call(ident, ident, ((1.0,),)) == '((1.0,),)'
+    assert len(calls) == 2
+
+
+def test_burst_expires_without_further_calls():
+    burst = memo.Burst(gap=0.05)
+    burst.touch()
+    token = burst.token(('repr', 1))
+    burst.put(token, 'value')
+    assert burst.get(token) == 'value'
+    time.sleep(0.3)
+    assert not burst.values and not burst.tokens
+    # A token is never reused for a different command
+    burst.touch()
+    assert burst.token(('repr', 2)) != token
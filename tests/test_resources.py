@@ -0,0 +1,69 @@
+import sqlite3
+import time
+
+import pytest
+
+from axl import resources
+
+
+def counts(found):
+    return dict(zip(('name', 'size', 'open', 'free', 'created', 'reused', 'evicted', 'failed'), found.stats()))
+
+
+def sqlite_pool(name, **kwargs):
+    return resources.register(name, 'sqlite3.connect', ':memory:', check='execute', check_args=('select 1',),
+                              check_interval=3600, **kwargs)
+
+
+def test_borrow_and_release():
+    found = sqlite_pool('test_borrow')
+    with resources.borrow('test_borrow') as first:
+        first.execute('create table t (x)')
+    with resources.borrow('test_borrow') as second:
+        assert second is first
+        with resources.borrow('test_borrow') as third:
+            assert third is not first
+    stats = counts(found)
+    assert (stats['created'], stats['reused'], stats['open'], stats['free']) == (2, 1, 2, 2)
+
+
+def test_suspect_is_checked_after_an_exception():
+    found = sqlite_pool('test_suspect')
+    with pytest.raises(ZeroDivisionError):
+        with resources.borrow('test_suspect') as conn:
+            conn.close()
+            1 / 0
+    with resources.borrow('test_suspect') as replacement:
+        assert replacement is not conn
+        assert replacement.execute('select 1').fetchone() == (1,)
+    stats = counts(found)
+    assert (stats['created'], stats['failed'], stats['open']) == (2, 1, 1)
+    # A resource returned after an exception is reused if it passes the check
+    with pytest.raises(ZeroDivisionError):
+        with resources.borrow('test_suspect'):
+            1 / 0
+    with resources.borrow('test_suspect') as again:
+        assert again is replacement
+    assert counts(found)['failed'] == 1
+
+
+def test_idle_resources_are_closed():
+    found = sqlite_pool('test_idle', idle=0.05)
+    with resources.borrow('test_idle') as conn:
+        pass
+    time.sleep(0.1)
+    with resources.borrow('test_idle') as fresh:
+        assert fresh is not conn
+    with pytest.raises(sqlite3.ProgrammingError):
+        conn.execute('select 1')
+    assert counts(found)['evicted'] == 1
+
+
+def test_exhaustion():
+    sqlite_pool('test_exhausted', size=1, wait=0.1)
+    with resources.borrow('test_exhausted'):
+        with pytest.raises(resources.ResourceError):
+            with resources.borrow('test_exhausted'):
+                pass
+    with resources.borrow('test_exhausted'):
+        pass
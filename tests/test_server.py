@@ -0,0 +1,232 @@
+import threading
+import time
+
+from axl import imports, plans, errors, server, memo, workers
+from axl.server import CommandLoop
+
+
+def reused(loop):
+    return dict(loop.Stats())['reused']
+
+
+def test_call_many():
+    loop = CommandLoop()
+    queues = [(('abs', -2.0), 'A1'), (('min', 3.0, 1.0), 'A2'), (('repr', (1.0, 2.0)), 'A3')]
+    assert loop.CallMany(queues) == [2.0, 1.0, '(1.0, 2.0)']
+    assert loop.CallMany(queues) == [loop.Call(queue) for queue in queues]
+
+
+def test_call_many_isolates_errors():
+    loop = CommandLoop()
+    results = loop.CallMany([(('abs', -2.0), 'A1'), (('test_no_such_function', 1.0), 'A2'),
+                             (('abs', 'text'), 'A3'), (('min', 3.0, 1.0), 'A4')])
+    assert results[0] == 2.0 and results[3] == 1.0
+    for code, text in ((results[1], 'test_no_such_function'), (results[2], 'abs')):
+        assert code.startswith(errors.PREFIX)
+        assert text in errors.table.lookup(code)
+
+
+def test_call_many_survives_malformed_entries():
+    loop = CommandLoop()
+    results = loop.CallMany([(('abs', -2.0), 'A1'), 'garbage', (), None, (('abs', -3.0), 'A5')])
+    assert results[0] == 2.0 and results[4] == 3.0
+    assert all(code.startswith(errors.PREFIX) for code in results[1:4])
+
+
+def test_reuse_distinguishes_types():
+    loop = CommandLoop()
+    loop.Options(reuse=True)
+    before = reused(loop)
+    assert loop.Call((('repr', ((1.0,),)), 'A1')) == '((1.0,),)'
+    assert loop.Call((('repr', ((True,),)), 'A1')) == '((True,),)'
+    assert loop.Call((('repr', ((True,),)), 'A1')) == '((True,),)'
+    assert reused(loop) - before == 1
+
+
+def test_share_distinguishes_types():
+    loop = CommandLoop()
+    loop.Options(share=True)
+    assert loop.Call((('repr', 0.0), 'B1')) == '0.0'
+    assert loop.Call((('repr', False), 'A1')) == 'False'
+    assert loop.Call((('repr', 0.0), 'C1')) == '0.0'
+
+
+def test_failed_coroutine_is_not_reused():
+    calls = []
+
+    async def flaky(x):
+        calls.append(x)
+        if len(calls) == 1:
+            raise IOError('transient')
+        return x
+    imports.add_symbol(None, 'test_flaky', flaky)
+    loop = CommandLoop()
+    loop.Options(reuse=True)
+    queue = (('test_flaky', 2.0), 'A1')
+    error = loop.Call(queue)
+    assert error.startswith(errors.PREFIX)
+    assert loop.Call(queue) == 2.0
+    # The result is stored by a callback, once the coroutine has finished
+    deadline = time.monotonic() + 5
+    while 'A1' not in loop.results_ and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert loop.Call(queue) == 2.0
+    assert len(calls) == 2
+
+
+def test_shared_coroutine_failure_has_one_code():
+    async def broken():
+        raise ValueError('broken')
+    imports.add_symbol(None, 'test_broken', broken)
+    loop = CommandLoop()
+    pending = loop._invoke(plans.compile_command(('test_broken',)), [], {})
+    codes = {loop._settle(pending) for _ in range(3)}
+    assert len(codes) == 1
+
+
+def test_identical_calls_coalesce():
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def slow(x):
+        calls.append(x)
+        started.set()
+        release.wait(5)
+        return x
+    imports.add_symbol(None, 'test_slow', slow)
+    loop = CommandLoop()
+    for count, make in ((2, tuple), (3, tuple), (3, list)):
+        del calls[:]
+        started.clear()
+        release.clear()
+        before = dict(loop.Stats())['coalesced']
+        results = []
+        queues = [make((('test_slow', float(count)), 'A{}'.format(n))) for n in range(count)]
+        threads = [threading.Thread(target=lambda q: results.append(loop.Call(q)), args=(q,)) for q in queues]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        deadline = time.monotonic() + 5
+        while dict(loop.Stats())['coalesced'] - before < count - 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        assert results == [float(count)] * count
+        assert dict(loop.Stats())['coalesced'] - before == count - 1
+        assert len(calls) == 1
+
+
+def test_coalescing_distinguishes_types():
+    started, release = threading.Event(), threading.Event()
+
+    def slow(x):
+        started.set()
+        release.wait(5)
+        return repr(x)
+    imports.add_symbol(None, 'test_slow_repr', slow)
+    loop = CommandLoop()
+    before = dict(loop.Stats())['coalesced']
+    results = {}
+    first = threading.Thread(target=lambda: results.update(A1=loop.Call((('test_slow_repr', True), 'A1'))))
+    first.start()
+    started.wait(5)
+    second = threading.Thread(target=lambda: results.update(A2=loop.Call((('test_slow_repr', 1.0), 'A2'))))
+    second.start()
+    time.sleep(0.1)
+    release.set()
+    first.join()
+    second.join()
+    assert results == {'A1': 'True', 'A2': '1.0'}
+    assert dict(loop.Stats())['coalesced'] == before
+
+
+def test_coalescing_can_be_turned_off():
+    loop = CommandLoop()
+    assert dict(loop.Options(coalesce=False))['coalesce'] is False
+    before = dict(loop.Stats())['coalesced']
+    threads = [threading.Thread(target=loop.Call, args=((('repr', 1.0), 'A{}'.format(n)),)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert dict(loop.Stats())['coalesced'] == before
+
+
+def test_background_results_are_collected_or_expire(monkeypatch):
+    loop = CommandLoop()
+    loop.Options(background=True)
+    queue = (('repr', 1.0), 'A1')
+    marker = loop.Call(queue)
+    assert marker.startswith(server.PENDING)
+    # The caller sends the same queue again until it gets the result
+    deadline = time.monotonic() + 5
+    result = marker
+    while result == marker and time.monotonic() < deadline:
+        time.sleep(0.01)
+        result = loop.Call(queue)
+    assert result == '1.0'
+    assert not loop.pending_ and not loop.callers_
+    # A result that is never retrieved is eventually discarded
+    monkeypatch.setattr(server, 'TICKET_SECONDS', 0)
+    loop.Call((('repr', 2.0), 'A2'))
+    while not loop.finished_ and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert loop.Poll() == []
+    assert not loop.pending_ and not loop.callers_
+
+
+def test_edit_is_not_held_up_by_recalculation():
+    release = threading.Event()
+
+    def stuck(x):
+        release.wait(10)
+        return x
+    imports.add_symbol(None, 'test_stuck', stuck)
+    loop = CommandLoop()
+    loop.Options(background=True)
+    try:
+        # A recalculation of two slow cells...
+        for n in range(2):
+            loop.Call((('test_stuck', float(n)), 'A{}'.format(n)))
+        time.sleep(memo.BURST_GAP + 0.1)
+        # ...and then an edit
+        marker = loop.Call((('abs', -1.0), 'B1'))
+        assert loop.Collect(marker, 2) == 1.0
+    finally:
+        release.set()
+
+
+def test_limited_calls_wait_without_taking_threads():
+    release = threading.Event()
+
+    def gate(x):
+        release.wait(10)
+        return x
+    imports.add_symbol(None, 'test_gate', gate)
+    loop = CommandLoop()
+    loop.Options(background=True)
+    loop.Limit('test_gate', 1)
+    try:
+        markers = [loop.Call((('test_gate', float(n)), 'A{}'.format(n))) for n in range(2 * workers.LANES['batch'])]
+        marker = loop.Call((('abs', -1.0), 'B1'))
+        assert loop.Collect(marker, 2) == 1.0
+        release.set()
+        assert [loop.Collect(marker, 5) for marker in markers] == [float(n) for n in range(len(markers))]
+    finally:
+        release.set()
+        loop.Limit('test_gate')
+
+
+def test_methods_calling_functions_have_budgets():
+    def slow(x):
+        time.sleep(0.05)
+        return x
+    imports.add_symbol(None, 'test_slow_point', slow)
+    loop = CommandLoop()
+    loop.Options(timeout=0.3)
+    start = time.monotonic()
+    result = loop.Call((('@Grid', 'test_slow_point', tuple((float(n),) for n in range(30))), 'A1'))
+    assert time.monotonic() - start < 1.0
+    assert 'Timeout' in errors.table.lookup(result)
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from axl import store
+from axl.server import CommandLoop
+
+
+def counts(st):
+    return dict(st.totals())
+
+
+def test_tiers(tmp_path):
+    st = store.SessionStore(max_bytes=1000000, directory=str(tmp_path))
+    compressible = np.zeros(100000)
+    noise = np.random.default_rng(0).random(100000)
+    st.save('[Book1.xlsx]Sheet1!$A$1', compressible)
+    st.save('[Book1.xlsx]Sheet1!$A$2', noise)
+    # Each array is 800 KB, so the first leaves the hot tier: it compresses
+    # well, so it is kept in memory. The second does not, so it is spilled
+    # to disk when the first is loaded back.
+    assert counts(st)['warm_entries'] == 1
+    assert np.array_equal(st.load('[Book1.xlsx]Sheet1!$A$1'), compressible)
+    assert np.array_equal(st.load('[Book1.xlsx]Sheet1!$A$1'), compressible)
+    stats = counts(st)
+    assert stats['promotions'] == 1 and stats['warm_hits'] == 2
+    assert stats['cold_entries'] == 1 and len(list(tmp_path.iterdir())) == 1
+    assert np.array_equal(st.load('[Book1.xlsx]Sheet1!$A$2'), noise)
+    assert counts(st)['cold_hits'] == 1
+    st.drop('Book1.xlsx')
+    assert not list(tmp_path.iterdir())
+
+
+def test_oversized_object_is_not_promoted(tmp_path):
+    st = store.SessionStore(max_bytes=1000000, directory=str(tmp_path))
+    big = np.random.default_rng(0).random(1000000)
+    st.save('[Book1.xlsx]Sheet1!$A$1', big)
+    for _ in range(20):
+        assert np.array_equal(st.load('[Book1.xlsx]Sheet1!$A$1'), big)
+    stats = counts(st)
+    assert stats['promotions'] == 0 and stats['demotions'] == 1
+    assert stats['cold_hits'] == 20
+
+
+def test_least_recently_used_are_evicted():
+    st = store.SessionStore(max_bytes=3000000, warm_bytes=0, cold_bytes=0)
+    arrays = [np.full(100000, float(n)) for n in range(4)]
+    for n in range(3):
+        st.save('[Book1.xlsx]Sheet1!$A${}'.format(n), arrays[n])
+    st.load('[Book1.xlsx]Sheet1!$A$0')
+    # Saving a fourth array evicts the one used least recently
+    st.save('[Book1.xlsx]Sheet1!$A$3', arrays[3])
+    for n in (0, 2, 3):
+        assert np.array_equal(st.load('[Book1.xlsx]Sheet1!$A${}'.format(n)), arrays[n])
+    with pytest.raises(store.Evicted):
+        st.load('[Book1.xlsx]Sheet1!$A$1')
+    # Saving the object again brings it back
+    st.save('[Book1.xlsx]Sheet1!$A$1', arrays[1])
+    assert np.array_equal(st.load('[Book1.xlsx]Sheet1!$A$1'), arrays[1])
+    assert st.load('[Book1.xlsx]Sheet1!$A$9') is None
+
+
+def test_cache_stats(monkeypatch):
+    st = store.SessionStore(warm_bytes=0, cold_bytes=0)
+    monkeypatch.setattr(CommandLoop, 'store_', st)
+    monkeypatch.setattr(CommandLoop, 'versions_', st.versions)
+    loop = CommandLoop()
+    for n in range(3):
+        loop.Save('[Book1.xlsx]Sheet1!$A${}'.format(n), np.zeros(100000))
+    # Call() wraps a table in a tuple of its own; see CommandLoop.Call()
+    stats = dict(loop.Call((('%CacheStats', 'max_bytes=', 2000000.0), 'B1'))[0])
+    assert (stats['hot_entries'], stats['hot_limit'], stats['evictions']) == (2, 2000000, 1)
+    assert stats['evicted_bytes'] == stats['hot_bytes'] // 2
+    loop.Load('[Book1.xlsx]Sheet1!$A$2')
+    assert loop.Load('[Book1.xlsx]Sheet1!$A$5') is None
+    with pytest.raises(store.Evicted):
+        loop.Load('[Book1.xlsx]Sheet1!$A$0')
+    stats = dict(loop.CacheStats())
+    assert (stats['hits'], stats['misses']) == (1, 2)
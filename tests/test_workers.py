@@ -0,0 +1,26 @@
+import threading
+import time
+
+import pytest
+
+from axl import imports, workers
+
+
+def nap(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def test_timeout_spares_other_process_calls():
+    imports.add_symbol(None, 'test_nap', nap)
+    results = []
+    other = threading.Thread(target=lambda: results.append(workers.call_in_process('test_nap', 1.0)))
+    other.start()
+    with pytest.raises(workers.Timeout):
+        workers.call_with_timeout(0.3, workers.call_in_process, 'test_nap', 10.0)
+    other.join()
+    assert results == [1.0]
+    # A spare process that finished its call is kept for the next
+    assert workers.call_with_timeout(5, workers.call_in_process, 'test_nap', 0.0) == 0.0
+    assert workers.call_with_timeout(5, workers.call_in_process, 'test_nap', 0.0) == 0.0
+    assert len(workers._spares) == 1